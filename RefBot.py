@@ -1,20 +1,48 @@
 import os
+import asyncio
+import functools
 import re
 import logging
-import mysql.connector
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import TelegramError
-from telegram.ext import (ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters)
+from telegram.helpers import escape_markdown
+from telegram.ext import (Application, ApplicationBuilder, CommandHandler, CallbackQueryHandler, ChatMemberHandler, ContextTypes, MessageHandler, filters)
 
 # Load environment variables
 from dotenv import load_dotenv
 load_dotenv()
 
+from cache import TTLCache
+from broadcast import Broadcaster
+from catalog import RewardsCatalog
+from db import Database
+from logconfig import configure_logging
+from leaderboard import Leaderboard
+from membership import MEMBER_STATUSES, MembershipTracker
+from metrics import DatabaseObserver, InstrumentedRequest, instrument_handler, registry, start_http_server
+from outbox import PRIORITY_HIGH, PRIORITY_LOW, Outbox, SharedTokenBucket
+from referral_graph import ReferralGraph
+from scheduler import KeyedScheduler
+from throttle import BUSY, Throttle
+from webhook import run_webhook
+
 # Bot token, username, and target channel from environment variables
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 BOT_USERNAME = os.getenv("BOT_USERNAME")
 TARGET_CHANNEL = os.getenv("TARGET_CHANNEL")
 
+# Comma-separated Telegram ids allowed to use admin commands
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip().isdigit()}
+
+# "polling" for development, "webhook" to spread updates over worker processes
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+
 # Sticker IDs
 STICKER_ID = os.getenv("STICKER_ID")
 STICKER_ID_2 = os.getenv("STICKER_ID_2")
@@ -22,8 +50,26 @@ STICKER_ID_3 = os.getenv("STICKER_ID_3")
 STICKER_ID_4 = os.getenv("STICKER_ID_4")
 STICKER_ID_5 = os.getenv("STICKER_ID_5")
 
-# Configure logging
-logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.INFO)
+# Logging: JSON lines written by a background thread. Below ERROR, each message
+# template is limited to LOG_RATE_LIMIT lines/s, and LOG_SAMPLE_RATES keeps only a
+# share of chosen templates, given as "template prefix=ratio" pairs
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_RATE_BURST = float(os.getenv("LOG_RATE_BURST", "100"))
+LOG_SAMPLE_RATES = {
+    prefix.strip(): float(ratio)
+    for prefix, _, ratio in (pair.rpartition("=") for pair in os.getenv("LOG_SAMPLE_RATES", "").split(","))
+    if prefix.strip() and ratio.strip()
+}
+
+def setup_logging():
+    # Idempotent; webhook workers call it again after fork to get their own writer thread
+    return configure_logging(
+        level=LOG_LEVEL, queue_size=LOG_QUEUE_SIZE, rate=LOG_RATE_LIMIT, burst=LOG_RATE_BURST, sample_rates=LOG_SAMPLE_RATES,
+    )
+
+setup_logging()
 logger = logging.getLogger(__name__)
 logging.getLogger("httpx").setLevel(logging.CRITICAL)
 logging.getLogger("telegram").setLevel(logging.CRITICAL)
@@ -37,12 +83,436 @@ DB_CONFIG = {
     'database': os.getenv("DB_NAME")
 }
 
-def get_db_connection():
+# Connection pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "60"))
+
+# Shared pool used by every handler; opened once in post_init
+db = Database(DB_CONFIG, pool_size=DB_POOL_SIZE, observer=DatabaseObserver())
+
+# Channel membership cache settings
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "300"))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "50000"))
+
+# Event-driven membership tracking and background reconciliation
+MEMBERSHIP_FLUSH_INTERVAL = float(os.getenv("MEMBERSHIP_FLUSH_INTERVAL", "2"))
+MEMBERSHIP_EVENT_TTL = float(os.getenv("MEMBERSHIP_EVENT_TTL", "86400"))
+MEMBERSHIP_TRUST_WINDOW = float(os.getenv("MEMBERSHIP_TRUST_WINDOW", "86400"))
+MEMBERSHIP_STALE_AFTER = float(os.getenv("MEMBERSHIP_STALE_AFTER", "86400"))
+MEMBERSHIP_RECONCILE_INTERVAL = float(os.getenv("MEMBERSHIP_RECONCILE_INTERVAL", "60"))
+MEMBERSHIP_RECONCILE_BATCH = int(os.getenv("MEMBERSHIP_RECONCILE_BATCH", "500"))
+MEMBERSHIP_RECONCILE_CONCURRENCY = int(os.getenv("MEMBERSHIP_RECONCILE_CONCURRENCY", "5"))
+MEMBERSHIP_RECONCILE_RATE = float(os.getenv("MEMBERSHIP_RECONCILE_RATE", "10"))
+
+# user_id -> bool, kept fresh by chat_member updates from TARGET_CHANNEL
+membership_cache = TTLCache(maxsize=MEMBERSHIP_CACHE_SIZE, ttl=MEMBERSHIP_CACHE_TTL)
+
+membership_tracker = MembershipTracker(
+    db,
+    membership_cache,
+    TARGET_CHANNEL,
+    flush_interval=MEMBERSHIP_FLUSH_INTERVAL,
+    event_ttl=MEMBERSHIP_EVENT_TTL,
+    trust_window=MEMBERSHIP_TRUST_WINDOW,
+    stale_after=MEMBERSHIP_STALE_AFTER,
+    reconcile_interval=MEMBERSHIP_RECONCILE_INTERVAL,
+    reconcile_batch=MEMBERSHIP_RECONCILE_BATCH,
+    reconcile_concurrency=MEMBERSHIP_RECONCILE_CONCURRENCY,
+    reconcile_rate=MEMBERSHIP_RECONCILE_RATE,
+)
+
+# Referral list settings
+REFERRALS_PAGE_SIZE = int(os.getenv("REFERRALS_PAGE_SIZE", "25"))
+PROFILE_LOOKUP_CONCURRENCY = int(os.getenv("PROFILE_LOOKUP_CONCURRENCY", "5"))
+
+# Outbound message scheduler settings
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_REPORT_INTERVAL = float(os.getenv("OUTBOX_REPORT_INTERVAL", "60"))
+# Global sends that broadcasts and other low-priority messages leave for replies
+OUTBOX_LOW_PRIORITY_RESERVE = float(os.getenv("OUTBOX_LOW_PRIORITY_RESERVE", "5"))
+
+# Every outgoing message goes through this queue; started in post_init
+outbox = Outbox(global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST,
+                low_priority_reserve=OUTBOX_LOW_PRIORITY_RESERVE)
+
+# Update processing: different users run in parallel, one user's updates run in order
+UPDATE_MAX_IN_FLIGHT = int(os.getenv("UPDATE_MAX_IN_FLIGHT", "64"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "10000"))
+UPDATE_REPORT_INTERVAL = float(os.getenv("UPDATE_REPORT_INTERVAL", "60"))
+
+update_scheduler = KeyedScheduler(max_in_flight=UPDATE_MAX_IN_FLIGHT, max_pending=UPDATE_MAX_PENDING)
+
+# Abuse throttling: per-user token buckets and a cap on admitted updates, checked
+# before an update is queued. Costs are "command=tokens" pairs; callback buttons
+# count as the command they open
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "0.5"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "6"))
+THROTTLE_COSTS = {
+    name.strip(): float(cost)
+    for name, _, cost in (pair.partition("=") for pair in os.getenv("THROTTLE_COSTS", "rewards=3,referrals=2,leaderboard=2,redeem=2,start=2").split(","))
+    if cost.strip()
+}
+THROTTLE_MAX_CONCURRENT = int(os.getenv("THROTTLE_MAX_CONCURRENT", "1000"))
+THROTTLE_COOLDOWN = float(os.getenv("THROTTLE_COOLDOWN", "10"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "100000"))
+
+throttle = Throttle(
+    rate=THROTTLE_RATE,
+    burst=THROTTLE_BURST,
+    costs=THROTTLE_COSTS,
+    max_concurrent=THROTTLE_MAX_CONCURRENT,
+    cooldown=THROTTLE_COOLDOWN,
+    max_users=THROTTLE_MAX_USERS,
+)
+
+# Referral crediting: credits go to a ledger and are applied to balances in batches
+REFERRAL_POINTS = 10
+REFERRAL_APPLY_INTERVAL = float(os.getenv("REFERRAL_APPLY_INTERVAL", "5"))
+REFERRAL_APPLY_BATCH = int(os.getenv("REFERRAL_APPLY_BATCH", "1000"))
+REFERRAL_NOTIFY_WINDOW = float(os.getenv("REFERRAL_NOTIFY_WINDOW", "60"))
+# Comma-separated points for the referrer's referrer, then the one above, ... Empty disables multi-level bonuses
+REFERRAL_LEVEL_BONUSES = [int(points) for points in os.getenv("REFERRAL_LEVEL_BONUSES", "").split(",") if points.strip().isdigit()]
+# Referrers in a run of this many single-referral accounts get no multi-level bonuses
+REFERRAL_CHAIN_THRESHOLD = int(os.getenv("REFERRAL_CHAIN_THRESHOLD", "5"))
+REFERRAL_GRAPH_SYNC_INTERVAL = float(os.getenv("REFERRAL_GRAPH_SYNC_INTERVAL", "30"))
+
+# Who referred whom, loaded in post_init and kept current by start() and periodic syncs
+referral_graph = ReferralGraph(chain_threshold=REFERRAL_CHAIN_THRESHOLD)
+
+# referrer_id -> [friends joined since the last notice, first few names]
+pending_referral_notices = {}
+background_tasks = set()
+
+# Rewards catalog settings
+REWARDS_PAGE_SIZE = int(os.getenv("REWARDS_PAGE_SIZE", "10"))
+REWARDS_REFRESH_INTERVAL = float(os.getenv("REWARDS_REFRESH_INTERVAL", "30"))
+
+catalog = RewardsCatalog(db, page_size=REWARDS_PAGE_SIZE, refresh_interval=REWARDS_REFRESH_INTERVAL)
+
+# Leaderboard settings
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "10"))
+LEADERBOARD_REFRESH_INTERVAL = float(os.getenv("LEADERBOARD_REFRESH_INTERVAL", "300"))
+
+leaderboard = Leaderboard(db, size=LEADERBOARD_SIZE, refresh_interval=LEADERBOARD_REFRESH_INTERVAL)
+
+# Broadcast settings
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "100"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+
+broadcaster = Broadcaster(db, outbox, batch_size=BROADCAST_BATCH_SIZE, progress_interval=BROADCAST_PROGRESS_INTERVAL)
+
+# user_id -> (username, first_name, last_name) last written to the database
+profile_cache = TTLCache(maxsize=MEMBERSHIP_CACHE_SIZE, ttl=24 * 3600)
+
+# Prometheus endpoint; webhook worker N serves on METRICS_PORT + N. 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Share of updates logged with a per-call timing breakdown
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+
+metrics_server = None
+
+def collect_cache_stats():
+    for name, cache in (("membership", membership_cache), ("profile", profile_cache)):
+        stats = cache.stats()
+        yield (name, "hits"), stats["hits"]
+        yield (name, "misses"), stats["misses"]
+        yield (name, "hit_rate"), stats["hit_rate"]
+        yield (name, "size"), stats["size"]
+    yield ("rewards_catalog", "reloads"), catalog.reloads
+
+def collect_outbox_stats():
+    for name, value in outbox.metrics().items():
+        yield (name,), value
+
+def collect_throttle_stats():
+    for name, value in throttle.stats().items():
+        yield (name,), value
+
+def collect_logging_stats():
+    handler = setup_logging()
+    yield ("queued",), handler.queue.qsize()
+    yield ("dropped",), handler.dropped
+
+def collect_update_stats():
+    stats = update_scheduler.stats()
+    for name in ("pending", "in_flight", "active_keys", "completed"):
+        yield (name,), stats[name]
+
+registry.gauge("invitepal_cache", "Cache statistics.", ["cache", "stat"], collect_cache_stats)
+registry.gauge("invitepal_outbox", "Outbound queue depth, counters and send latency in seconds.", ["stat"], collect_outbox_stats)
+registry.gauge("invitepal_updates", "Update scheduler queue statistics.", ["stat"], collect_update_stats)
+registry.gauge("invitepal_logging", "Log records waiting to be written or dropped on a full queue.", ["stat"], collect_logging_stats)
+registry.gauge("invitepal_throttle", "Admitted and rejected user updates.", ["stat"], collect_throttle_stats)
+
+async def post_init(application):
     try:
-        return mysql.connector.connect(**DB_CONFIG)
+        await asyncio.get_running_loop().run_in_executor(None, db.open)
     except Exception as e:
-        logger.error("Could not connect to the database.")
+        logger.exception("Could not connect to the database: %s", e)
         raise
+    db.start_health_checks(DB_HEALTH_CHECK_INTERVAL)
+    outbox.start(application.bot, report_interval=OUTBOX_REPORT_INTERVAL)
+    update_scheduler.start_reporting(UPDATE_REPORT_INTERVAL)
+    start_background_task(referral_ledger_loop())
+    try:
+        await referral_graph.load(db)
+    except Exception as e:
+        logger.exception("Could not build the referral graph: %s", e)
+    start_background_task(referral_graph_sync_loop())
+    leaderboard.start()
+    # Only one webhook worker reconciles memberships and picks up broadcasts
+    # interrupted by a restart
+    primary = application.bot_data.get("worker_index", 0) == 0
+    membership_tracker.start(application.bot, reconcile=primary, on_join=credit_new_members)
+    if primary:
+        try:
+            await broadcaster.resume()
+        except Exception as e:
+            logger.exception("Could not resume broadcasts: %s", e)
+    global metrics_server
+    if METRICS_PORT and metrics_server is None:
+        metrics_server = start_http_server(METRICS_PORT + application.bot_data.get("worker_index", 0), METRICS_HOST)
+
+async def drain_pending_work():
+    # Runs from Application.stop(), while the bot can still send
+    await update_scheduler.join()
+    for task in list(background_tasks):
+        task.cancel()
+    # Broadcasts are checkpointed per batch and resume on the next start
+    await broadcaster.stop()
+    await membership_tracker.stop()
+    await leaderboard.stop()
+    await apply_pending_referral_credits()
+    for referrer_id in list(pending_referral_notices):
+        flush_referral_notice(referrer_id)
+    await outbox.stop()
+
+async def post_shutdown(application):
+    global metrics_server
+    update_scheduler.stop_reporting()
+    if metrics_server:
+        metrics_server.shutdown()
+        metrics_server = None
+    await db.close()
+
+def update_key(update):
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    # Nothing to keep in order with
+    return id(update)
+
+def throttled_command(update):
+    # Only user-initiated messages and button presses are throttled
+    if not isinstance(update, Update) or not update.effective_user or update.effective_user.id in ADMIN_IDS:
+        return None
+    if update.callback_query:
+        return (update.callback_query.data or "").split(":", 1)[0]
+    if update.message and update.message.text:
+        text = update.message.text
+        return text.split()[0][1:].split("@", 1)[0].lower() if text.startswith("/") else "text"
+    return None
+
+async def answer_quietly(callback_query, text):
+    try:
+        await callback_query.answer(text)
+    except TelegramError as e:
+        logger.warning("Could not answer throttled callback query: %s", e)
+
+def reject_update(update, reason):
+    user_id = update.effective_user.id
+    if not throttle.should_notify(user_id):
+        return
+    logger.warning("Throttled user %s (%s).", user_id, reason)
+    if reason == BUSY:
+        text = "I'm very busy right now. Please try again in a few seconds."
+    else:
+        text = f"Slow down a little. Please try again in {int(THROTTLE_COOLDOWN)} seconds."
+    if update.callback_query:
+        start_background_task(answer_quietly(update.callback_query, text))
+    elif update.effective_chat:
+        outbox.send_message(chat_id=update.effective_chat.id, text=f"*{text}*", parse_mode="Markdown", priority=PRIORITY_LOW)
+
+class OrderedApplication(Application):
+    # The update fetcher hands each update to process_update; queueing it on the
+    # scheduler instead of awaiting it lets other users' updates proceed
+    async def process_update(self, update):
+        command = throttled_command(update)
+        if command is None:
+            await update_scheduler.submit(update_key(update), lambda: super(OrderedApplication, self).process_update(update))
+            return
+
+        # Rejected updates never reach a handler, the database or get_chat_member
+        reason = throttle.admit(update.effective_user.id, command)
+        if reason:
+            reject_update(update, reason)
+            return
+
+        async def job():
+            try:
+                await super(OrderedApplication, self).process_update(update)
+            finally:
+                throttle.release()
+        await update_scheduler.submit(update_key(update), job)
+
+    async def stop(self):
+        await super().stop()
+        # Let queued handlers and outgoing messages finish while the bot can still send
+        await drain_pending_work()
+
+def start_background_task(coroutine):
+    task = asyncio.get_running_loop().create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def credit_referrer(cursor, referrer_id, user_id, upline=()):
+    # Claiming points_credited first makes a repeated /start a no-op. The credit
+    # itself goes to the ledger so a busy referrer's row is not locked per referral
+    cursor.execute("UPDATE Users SET points_credited = TRUE WHERE telegram_id = %s AND NOT points_credited", (user_id,))
+    if cursor.rowcount == 0:
+        return False
+    # Level 1 is the direct referrer; upline holds the referrers above it, nearest first
+    credits = [(referrer_id, user_id, REFERRAL_POINTS, 1)]
+    credits += [
+        (ancestor_id, user_id, points, level)
+        for level, (ancestor_id, points) in enumerate(zip(upline, REFERRAL_LEVEL_BONUSES), start=2)
+        if ancestor_id != user_id and points
+    ]
+    cursor.executemany(
+        "INSERT INTO ReferralCredits (referrer_id, referee_id, points, level) VALUES (%s, %s, %s, %s)",
+        credits,
+    )
+    return True
+
+def referral_upline(referrer_id):
+    if not REFERRAL_LEVEL_BONUSES or referral_graph.is_suspicious(referrer_id):
+        return []
+    return referral_graph.ancestors(referrer_id, len(REFERRAL_LEVEL_BONUSES))
+
+def register_user(cursor, user_id, username, first_name, last_name, referred_by, joined):
+    # Users already in the channel never join through the referral, so nothing is owed for them
+    cursor.execute(
+        "INSERT INTO Users (telegram_id, username, first_name, last_name, referred_by, is_joined, points_credited, membership_checked_at) VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)",
+        (user_id, username, first_name, last_name, referred_by, joined, joined),
+    )
+    if referred_by:
+        # Kept in the same transaction so referral_count never drifts from the rows
+        cursor.execute("UPDATE Users SET referral_count = referral_count + 1 WHERE telegram_id = %s", (referred_by,))
+
+async def credit_new_members(user_ids):
+    # Called by the membership tracker with users whose stored is_joined just went
+    # from false to true, whether /start, a chat_member update or reconciliation saw it
+    user_ids = sorted(user_ids)
+    for i in range(0, len(user_ids), 1000):
+        chunk = user_ids[i:i + 1000]
+        rows = await db.fetchall(
+            f"SELECT telegram_id, referred_by, first_name FROM Users WHERE telegram_id IN ({', '.join(['%s'] * len(chunk))}) "
+            "AND referred_by IS NOT NULL AND referred_by != telegram_id AND NOT points_credited",
+            chunk,
+        )
+        for user_id, referrer_id, first_name in rows:
+            if await db.run(credit_referrer, referrer_id, user_id, referral_upline(referrer_id)):
+                logger.info("Recorded referral credit for referrer %s due to referral by %s", referrer_id, user_id)
+                notify_referrer(referrer_id, first_name or "Your friend")
+
+def apply_referral_credits(cursor, batch_size):
+    # SKIP LOCKED lets several workers apply disjoint batches at the same time
+    cursor.execute(
+        "SELECT id, referrer_id, points, level FROM ReferralCredits WHERE applied_at IS NULL ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED",
+        (batch_size,),
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return 0
+    totals = {}
+    for _, referrer_id, points, level in rows:
+        points_total, credits = totals.get(referrer_id, (0, 0))
+        totals[referrer_id] = (points_total + points, credits + (level == 1))
+    # Fixed lock order avoids deadlocks between concurrent batches. Each level 1 row
+    # is one referee who joined, so it also counts as a successful referral
+    cursor.executemany(
+        "UPDATE Users SET points_available = points_available + %s, successful_referral_count = successful_referral_count + %s WHERE telegram_id = %s",
+        [(*totals[referrer_id], referrer_id) for referrer_id in sorted(totals)],
+    )
+    ids = [row[0] for row in rows]
+    cursor.execute(
+        f"UPDATE ReferralCredits SET applied_at = CURRENT_TIMESTAMP WHERE id IN ({', '.join(['%s'] * len(ids))})",
+        ids,
+    )
+    return len(rows)
+
+async def apply_pending_referral_credits():
+    applied = 0
+    try:
+        while True:
+            count = await db.run(apply_referral_credits, REFERRAL_APPLY_BATCH)
+            applied += count
+            if count < REFERRAL_APPLY_BATCH:
+                break
+    except Exception as e:
+        logger.exception("Error applying referral credits: %s", e)
+    if applied:
+        logger.info("Applied %s referral credits.", applied)
+    return applied
+
+async def referral_ledger_loop():
+    while True:
+        await asyncio.sleep(REFERRAL_APPLY_INTERVAL)
+        await apply_pending_referral_credits()
+
+async def referral_graph_sync_loop():
+    # Webhook workers only see their own shard's /start calls; this picks up the rest
+    while True:
+        await asyncio.sleep(REFERRAL_GRAPH_SYNC_INTERVAL)
+        try:
+            await referral_graph.sync(db)
+        except Exception as e:
+            logger.exception("Error syncing the referral graph: %s", e)
+
+def notify_referrer(referrer_id, friend_name):
+    # The first referral in a window is announced right away; later ones are
+    # summed up in one message when the window closes
+    notice = pending_referral_notices.get(referrer_id)
+    if notice is None:
+        pending_referral_notices[referrer_id] = [0, []]
+        asyncio.get_running_loop().call_later(REFERRAL_NOTIFY_WINDOW, flush_referral_notice, referrer_id)
+        outbox.send_sticker(chat_id=referrer_id, sticker=STICKER_ID_2, priority=PRIORITY_LOW)
+        outbox.send_message(chat_id=referrer_id, text=f"*Good news! {escape_markdown(friend_name)} is with us now.*\nI've given you *{REFERRAL_POINTS} points* for bringing them in. Keep it up!", parse_mode="Markdown", priority=PRIORITY_LOW)
+        return
+    notice[0] += 1
+    if len(notice[1]) < 3:
+        notice[1].append(friend_name)
+
+def flush_referral_notice(referrer_id):
+    notice = pending_referral_notices.pop(referrer_id, None)
+    if not notice or not notice[0]:
+        return
+    count, names = notice
+    if count == 1:
+        text = f"*Good news! {escape_markdown(names[0])} is with us now.*\nI've given you *{REFERRAL_POINTS} points* for bringing them in. Keep it up!"
+    else:
+        others = f" and {count - len(names)} more" if count > len(names) else ""
+        text = (
+            f"*Good news! {count} friends joined, +{count * REFERRAL_POINTS} points.*\n"
+            f"Including {escape_markdown(', '.join(names))}{others}. Keep it up!"
+        )
+    outbox.send_sticker(chat_id=referrer_id, sticker=STICKER_ID_2, priority=PRIORITY_LOW)
+    outbox.send_message(chat_id=referrer_id, text=text, parse_mode="Markdown", priority=PRIORITY_LOW)
+
+def redeem_reward(cursor, user_id, item_id):
+    # The redeem_reward procedure (see Sample_DB.sql) runs in its own transaction and
+    # claims one credential from the RewardCredentials pool and
+    # returns (status, item_description, secret_1, secret_2); status is one of
+    # ok, unknown_user, unknown_item, sold_out, insufficient_points
+    cursor.callproc("redeem_reward", (user_id, item_id))
+    for result in cursor.stored_results():
+        return result.fetchone()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -50,97 +520,147 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         username = update.effective_user.username or "Unknown"
         referred_by = int(context.args[0]) if context.args and context.args[0].isdigit() else None
 
-        logger.info(f"Processing /start command for user {user_id} (@{username})")
-
-        # Check if user is in the channel
-        is_member = await context.bot.get_chat_member(TARGET_CHANNEL, user_id)
-        joined = is_member.status in ["member", "administrator", "creator"]
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        logger.info("Processing /start command for user %s (@%s)", user_id, username)
 
         # Query user data from the database
-        cursor.execute("SELECT is_joined, referred_by, points_credited FROM Users WHERE telegram_id = %s", (user_id,))
-        result = cursor.fetchone()
+        result = await db.fetchone(
+            "SELECT is_joined, is_blocked, membership_checked_at > NOW() - INTERVAL %s SECOND FROM Users WHERE telegram_id = %s",
+            (int(MEMBERSHIP_TRUST_WINDOW), user_id),
+        )
+
+        # Check if user is in the channel; a recently confirmed row saves the API call
+        joined = membership_cache.get(user_id)
+        if joined is None and result and result[2]:
+            joined = bool(result[0])
+            membership_cache.set(user_id, joined)
+        if joined is None:
+            joined = await fetch_channel_membership(context, user_id)
 
         if result:
-            is_joined_db, db_referred_by, points_credited = result
+            is_joined_db, is_blocked, _ = result
+            await remember_profile(update.effective_user)
+            if is_blocked:
+                # They are talking to us again, so include them in broadcasts
+                await db.execute("UPDATE Users SET is_blocked = FALSE WHERE telegram_id = %s", (user_id,))
+
+            if joined != bool(is_joined_db):
+                membership_tracker.record(user_id, joined)
+                referral_graph.set_joined(user_id, joined)
+                logger.info("Updated is_joined status to %s for user %s", joined, user_id)
 
             if joined:
-                if not is_joined_db:
-                    cursor.execute("UPDATE Users SET is_joined = TRUE WHERE telegram_id = %s", (user_id,))
-                    conn.commit()
-                    logger.info(f"Updated is_joined status to TRUE for user {user_id}")
-
-                    # Credit points to the referrer only if not credited before
-                    if db_referred_by and db_referred_by != user_id and not points_credited:
-                        cursor.execute("UPDATE Users SET points_available = points_available + 10 WHERE telegram_id = %s", (db_referred_by,))
-                        cursor.execute("UPDATE Users SET points_credited = TRUE WHERE telegram_id = %s", (user_id,))
-                        conn.commit()
-                        logger.info(f"Incremented points for referrer {db_referred_by} due to referral by {user_id}")
-                        await context.bot.send_sticker(chat_id=db_referred_by, sticker=STICKER_ID_2)
-                        await context.bot.send_message(chat_id=db_referred_by, text=f"*Good news! {update.effective_user.first_name} is with us now.*\nI've given you *10 points* for bringing them in. Keep it up!", parse_mode ="Markdown")
+                # The referrer is credited by the membership tracker once the change to joined is written
                 await display_menu(update, context)
             else:
-                cursor.execute("UPDATE Users SET is_joined = FALSE WHERE telegram_id = %s", (user_id,))
-                conn.commit()
-                logger.warning(f"User {user_id} not joined the channel. Prompting to join.")
+                logger.info("User %s not joined the channel. Prompting to join.", user_id)
                 await prompt_join_channel(update, context)
         else:
             # Insert new user into the database
-            cursor.execute(
-                "INSERT INTO Users (telegram_id, username, referred_by, is_joined, points_credited) VALUES (%s, %s, %s, %s, %s)",
-                (user_id, username, referred_by if referred_by and referred_by != user_id else None, joined, False),
-            )
-            conn.commit()
-            logger.info(f"New user {user_id} added to the database.")
+            first_name = update.effective_user.first_name
+            last_name = update.effective_user.last_name
+            referred_by = referred_by if referred_by and referred_by != user_id else None
+            await db.run(register_user, user_id, username, first_name, last_name, referred_by, joined)
+            referral_graph.add(user_id, referred_by, joined)
+            profile_cache.set(user_id, (username, first_name, last_name))
+            logger.info("New user %s added to the database.", user_id)
 
             if joined:
                 await display_menu(update, context)
             else:
-                logger.warning(f"New user {user_id} not joined the channel. Prompting to join.")
+                logger.info("New user %s not joined the channel. Prompting to join.", user_id)
                 await prompt_join_channel(update, context)
 
-        cursor.close()
-        conn.close()
-
     except Exception as e:
-        logger.error(f"An error occurred in /start command: {e}")
+        logger.exception("An error occurred in /start command: %s", e)
+
+async def remember_profile(user):
+    # Store display names so /referrals never has to ask Telegram for them
+    profile = (user.username or "Unknown", user.first_name, user.last_name)
+    if profile_cache.get(user.id) == profile:
+        return
+    await db.execute(
+        "UPDATE Users SET username = %s, first_name = %s, last_name = %s WHERE telegram_id = %s",
+        (*profile, user.id),
+    )
+    profile_cache.set(user.id, profile)
+
+async def fetch_channel_membership(context: ContextTypes.DEFAULT_TYPE, user_id):
+    is_member = await context.bot.get_chat_member(TARGET_CHANNEL, user_id)
+    joined = is_member.status in MEMBER_STATUSES
+    # Caches the answer and refreshes the user's row in the next batched write
+    membership_tracker.record(user_id, joined)
+    return joined
+
+async def is_channel_member(context: ContextTypes.DEFAULT_TYPE, user_id):
+    joined = membership_cache.get(user_id)
+    if joined is None:
+        joined = await membership_tracker.lookup(user_id)
+    if joined is None:
+        joined = await fetch_channel_membership(context, user_id)
+    return joined
+
+def is_target_channel(chat):
+    if str(chat.id) == TARGET_CHANNEL:
+        return True
+    return bool(chat.username) and f"@{chat.username}".lower() == (TARGET_CHANNEL or "").lower()
+
+async def track_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        member_update = update.chat_member
+        if not is_target_channel(member_update.chat):
+            return
+        user_id = member_update.new_chat_member.user.id
+        joined = member_update.new_chat_member.status in MEMBER_STATUSES
+        # Telegram pushes these as they happen, so the new state can be taken as-is
+        membership_tracker.record(user_id, joined, from_event=True)
+        referral_graph.set_joined(user_id, joined)
+        logger.info("Channel membership changed for user %s: joined=%s", user_id, joined)
+    except Exception as e:
+        logger.exception("Error in track_channel_membership: %s", e)
 
 def channel_membership_required(func):
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         try:
             user_id = update.effective_user.id
-            is_member = await context.bot.get_chat_member(TARGET_CHANNEL, user_id)
-            if is_member.status in ["member", "administrator", "creator"]:
+            if await is_channel_member(context, user_id):
+                await remember_profile(update.effective_user)
                 return await func(update, context, *args, **kwargs)
             else:
                 await prompt_join_channel(update, context)
         except Exception as e:
-            logger.error(f"Error in channel_membership_required for user {user_id}: {e}")
+            logger.exception("Error in channel_membership_required for user %s: %s", user_id, e)
+    return wrapper
+
+def admin_only(func):
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        if update.effective_user.id not in ADMIN_IDS:
+            logger.warning("User %s tried to use an admin command.", update.effective_user.id)
+            return
+        return await func(update, context, *args, **kwargs)
     return wrapper
 
 async def display_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        logger.info(f"Displaying menu for user {update.effective_user.id}")
+        logger.info("Displaying menu for user %s", update.effective_user.id)
         keyboard = [
             [InlineKeyboardButton("List Rewards", callback_data="rewards"),
              InlineKeyboardButton("Get Referral Link", callback_data="referral_link")],
             [InlineKeyboardButton("My Referrals", callback_data="referrals"),
              InlineKeyboardButton("My Balance", callback_data="balance")],
             [InlineKeyboardButton("Redeem Rewards", callback_data="redeem"),
-             InlineKeyboardButton("Get Help", callback_data="help")]
+             InlineKeyboardButton("Leaderboard", callback_data="leaderboard")],
+            [InlineKeyboardButton("Get Help", callback_data="help")]
         ]
 
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_sticker(chat_id=update.effective_chat.id, sticker=STICKER_ID_3)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"*Hello {update.effective_user.first_name}!*\nSelect what you want me to do:", parse_mode="Markdown", reply_markup=reply_markup)
+        outbox.send_sticker(chat_id=update.effective_chat.id, sticker=STICKER_ID_3)
+        outbox.send_message(chat_id=update.effective_chat.id, text=f"*Hello {update.effective_user.first_name}!*\nSelect what you want me to do:", parse_mode="Markdown", reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"Error in display_menu for user {update.effective_user.id}: {e}")
+        logger.exception("Error in display_menu for user %s: %s", update.effective_user.id, e)
 
 async def prompt_join_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        await context.bot.send_message(
+        outbox.send_message(
             chat_id=update.effective_chat.id,
             text="*Please join our channel to use this feature.\nOnce joined, press /start again.*",
             parse_mode="Markdown",
@@ -149,7 +669,7 @@ async def prompt_join_channel(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
         )
     except Exception as e:
-        logger.error(f"Error in prompt_join_channel for user {update.effective_user.id}: {e}")
+        logger.exception("Error in prompt_join_channel for user %s: %s", update.effective_user.id, e)
 
 def escape_md(text):
     # Escape all special MarkdownV2 characters
@@ -160,9 +680,9 @@ def escape_md(text):
 async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        logger.info(f"Unknown message received from user {user_id}: {update.message.text}")
+        logger.info("Unknown message received from user %s: %s", user_id, update.message.text)
         
-        await context.bot.send_message(
+        outbox.send_message(
             chat_id=update.effective_chat.id,
             text=(
                 "🤔 *I'm not sure what you meant by that.*"
@@ -170,201 +690,323 @@ async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown"
         )
     except Exception as e:
-        logger.error(f"Error in fallback handler for user {update.effective_user.id}: {e}")
+        logger.exception("Error in fallback handler for user %s: %s", update.effective_user.id, e)
 
 @channel_membership_required
-async def handle_rewards(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_rewards(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
     try:
-        logger.info(f"Fetching rewards for user {update.effective_user.id}")
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        logger.info("Fetching rewards page %s for user %s", page, update.effective_user.id)
+        pages = await catalog.pages()
 
-        cursor.execute("SELECT item_id, item_description, points_required, redeemed_count, max_count FROM Rewards")
-        rewards = cursor.fetchall()
-
-        if not rewards:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="*No rewards available at the moment.*", parse_mode="Markdown")
+        if not pages:
+            outbox.send_message(chat_id=update.effective_chat.id, text="*No rewards available at the moment.*", parse_mode="Markdown")
             return
 
-        for reward in rewards:
-            item_id, item_description, points_required, redeemed_count, max_count = reward
+        page = min(max(page, 0), len(pages) - 1)
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("« Previous", callback_data=f"rewards:{page - 1}"))
+        if page < len(pages) - 1:
+            buttons.append(InlineKeyboardButton("Next »", callback_data=f"rewards:{page + 1}"))
+        reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+
+        if update.callback_query and update.callback_query.data.startswith("rewards:"):
+            # Page navigation edits the catalog in place
+            outbox.submit("edit_message_text", update.effective_chat.id, message_id=update.callback_query.message.message_id,
+                          text=pages[page], parse_mode="Markdown", reply_markup=reply_markup)
+        else:
+            outbox.send_message(chat_id=update.effective_chat.id, text=pages[page], parse_mode="Markdown", reply_markup=reply_markup)
+        logger.info("Sent reward details to user %s", update.effective_user.id)
 
-            # Calculate available slots
-            slots_available = max_count - redeemed_count
+    except Exception as e:
+        logger.exception("Error in handle_rewards for user %s: %s", update.effective_user.id, e)
 
-            # Prepare the message for each reward
-            message = (
-                f"*Item ID:* {item_id}\n"
-                f"*Name: {item_description}*\n"
-                f"*Slots: {slots_available}* out of {max_count} available\n"
-                f"*Points Required:* {points_required}"
-            )
+async def track_bot_blocked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        member_update = update.my_chat_member
+        if member_update.chat.type != "private":
+            return
+        blocked = member_update.new_chat_member.status == "kicked"
+        await db.execute("UPDATE Users SET is_blocked = %s WHERE telegram_id = %s", (blocked, member_update.chat.id))
+        logger.info("User %s %s the bot.", member_update.chat.id, "blocked" if blocked else "unblocked")
+    except Exception as e:
+        logger.exception("Error in track_bot_blocked: %s", e)
 
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message, parse_mode="Markdown")
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="*When you have enough points, you can redeem any item above ☝️ at anytime.\n I'm here to serve you 24x7 😎*", parse_mode="Markdown")
-        logger.info(f"Sent reward details to user {update.effective_user.id}")
+@admin_only
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        parts = update.message.text.split(None, 1)
+        if len(parts) < 2:
+            outbox.send_message(chat_id=update.effective_chat.id, text="*This is the syntax you must follow:\n/broadcast <message>*", parse_mode="Markdown")
+            return
+        broadcast_id, total = await broadcaster.start(update.effective_user.id, parts[1])
+        outbox.send_message(chat_id=update.effective_chat.id, text=f"*Broadcast #{broadcast_id} queued for {total} users.*\nCancel it with /broadcast\\_cancel {broadcast_id}", parse_mode="Markdown")
+    except Exception as e:
+        logger.exception("Error in broadcast for user %s: %s", update.effective_user.id, e)
 
+@admin_only
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if len(context.args) != 1 or not context.args[0].isdigit():
+            outbox.send_message(chat_id=update.effective_chat.id, text="*This is the syntax you must follow:\n/broadcast\\_cancel <broadcast-id>*", parse_mode="Markdown")
+            return
+        if await broadcaster.cancel(int(context.args[0])):
+            outbox.send_message(chat_id=update.effective_chat.id, text=f"*Broadcast #{context.args[0]} will stop after the current batch.*", parse_mode="Markdown")
+        else:
+            outbox.send_message(chat_id=update.effective_chat.id, text="*No running broadcast with that id.*", parse_mode="Markdown")
     except Exception as e:
-        logger.error(f"Error in handle_rewards for user {update.effective_user.id}: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+        logger.exception("Error in broadcast_cancel for user %s: %s", update.effective_user.id, e)
+
+@admin_only
+async def reload_rewards(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        catalog.invalidate()
+        pages = await catalog.pages()
+        outbox.send_message(chat_id=update.effective_chat.id, text=f"*Rewards catalog reloaded ({len(pages)} pages).*", parse_mode="Markdown")
+        logger.info("Rewards catalog reloaded by admin %s", update.effective_user.id)
+    except Exception as e:
+        logger.exception("Error in reload_rewards for user %s: %s", update.effective_user.id, e)
+
+@admin_only
+async def referral_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if context.args and context.args[0].isdigit():
+            user_id = int(context.args[0])
+            if user_id not in referral_graph:
+                outbox.send_message(chat_id=update.effective_chat.id, text="*That user is not in the referral graph.*", parse_mode="Markdown")
+                return
+            upline = referral_graph.ancestors(user_id, 5)
+            chain = referral_graph.chain_length(user_id)
+            lines = [
+                f"*Referral report for {user_id}*",
+                f"Direct referrals: {referral_graph.direct_referrals(user_id)}",
+                f"All referrals below: {referral_graph.subtree_size(user_id)}",
+                f"Throwaway referrals: {referral_graph.throwaway_referrals(user_id)}",
+                f"Single-referral chain: {chain}" + (" (suspicious)" if chain >= REFERRAL_CHAIN_THRESHOLD else ""),
+                f"Referred by: {' <- '.join(map(str, upline)) if upline else 'nobody'}",
+            ]
+        else:
+            clusters = referral_graph.suspicious_clusters()
+            lines = ["*Largest suspicious referral clusters:*"]
+            lines += [f"{telegram_id}: {size} {'chained accounts' if kind == 'chain' else 'throwaway referrals'}" for telegram_id, kind, size in clusters]
+            if not clusters:
+                lines.append("None found.")
+        outbox.send_message(chat_id=update.effective_chat.id, text="\n".join(lines), parse_mode="Markdown")
+    except Exception as e:
+        logger.exception("Error in referral_report for user %s: %s", update.effective_user.id, e)
 
 @channel_membership_required
 async def get_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
         link = f"https://t.me/{BOT_USERNAME}?start={user_id}"
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"*Your referral link:\n{link}*", parse_mode="Markdown")
-        await context.bot.send_sticker(chat_id=update.effective_chat.id, sticker=STICKER_ID_4)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"*Share among your friends, {update.effective_user.first_name}!*", parse_mode="Markdown")
-        logger.info(f"Sent referral link to user {user_id}")
+        outbox.send_message(chat_id=update.effective_chat.id, text=f"*Your referral link:\n{link}*", parse_mode="Markdown")
+        outbox.send_sticker(chat_id=update.effective_chat.id, sticker=STICKER_ID_4)
+        outbox.send_message(chat_id=update.effective_chat.id, text=f"*Share among your friends, {update.effective_user.first_name}!*", parse_mode="Markdown")
+        logger.info("Sent referral link to user %s", user_id)
     except Exception as e:
-        logger.error(f"Error in get_link for user {update.effective_user.id}: {e}")
+        logger.exception("Error in get_link for user %s: %s", update.effective_user.id, e)
+
+def store_profiles(cursor, profiles):
+    cursor.executemany(
+        "UPDATE Users SET username = %s, first_name = %s, last_name = %s WHERE telegram_id = %s",
+        [(username, first_name, last_name, telegram_id) for telegram_id, (username, first_name, last_name) in profiles.items()],
+    )
+
+async def fetch_missing_profiles(context: ContextTypes.DEFAULT_TYPE, telegram_ids):
+    semaphore = asyncio.Semaphore(PROFILE_LOOKUP_CONCURRENCY)
+
+    async def lookup(telegram_id):
+        async with semaphore:
+            try:
+                user = await context.bot.get_chat(telegram_id)
+                return telegram_id, (user.username or "Unknown", user.first_name, user.last_name)
+            except Exception as e:
+                # Handle cases where the Telegram ID is invalid or user info is not accessible
+                logger.exception("Could not fetch details for Telegram ID %s: %s", telegram_id, e)
+                return telegram_id, None
+
+    results = await asyncio.gather(*(lookup(telegram_id) for telegram_id in telegram_ids))
+    profiles = {telegram_id: profile for telegram_id, profile in results if profile}
+    if profiles:
+        await db.run(store_profiles, profiles)
+    return profiles
+
+def format_referral(telegram_id, username, first_name, last_name):
+    if not first_name:
+        return f"*- Telegram ID: {telegram_id} (details not available)*"
+    full_name = f"{first_name} {last_name}" if last_name else first_name
+    username = f"@{username}" if username and username != "Unknown" else "no username"
+    return f"*- {escape_markdown(full_name)} ({escape_markdown(username)})*"
 
 @channel_membership_required
-async def referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def referrals(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
     try:
         user_id = update.effective_user.id
-        logger.info(f"Fetching referrals for user {user_id}")
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Fetch Telegram IDs from the database
-        cursor.execute("SELECT telegram_id FROM Users WHERE referred_by = %s", (user_id,))
-        referrals = cursor.fetchall()
-
-        # Initialize the message
-        if referrals:
-            message = "*Friends who have joined us:*\n\n"
-            for referral in referrals:
-                telegram_id = referral[0]
-                try:
-                    # Fetch user details using the Telegram API
-                    user = await context.bot.get_chat(telegram_id)
-                    full_name = f"{user.first_name} {user.last_name}" if user.last_name else user.first_name
-                    username = f"@{user.username}" if user.username else "no username"
-                    message += f"*- {full_name} ({username})*\n"
-                except Exception as e:
-                    # Handle cases where the Telegram ID is invalid or user info is not accessible
-                    logger.error(f"Could not fetch details for Telegram ID {telegram_id}: {e}")
-                    message += f"*- Telegram ID: {telegram_id} (details not available)*\n"
+        logger.info("Fetching referrals page %s for user %s", page, user_id)
+
+        # One extra row tells us whether there is a next page
+        rows = await db.fetchall(
+            "SELECT telegram_id, username, first_name, last_name FROM Users WHERE referred_by = %s ORDER BY telegram_id LIMIT %s OFFSET %s",
+            (user_id, REFERRALS_PAGE_SIZE + 1, page * REFERRALS_PAGE_SIZE),
+        )
+        has_next = len(rows) > REFERRALS_PAGE_SIZE
+        rows = rows[:REFERRALS_PAGE_SIZE]
+
+        reply_markup = None
+        if rows:
+            missing = [row[0] for row in rows if not row[2]]
+            profiles = await fetch_missing_profiles(context, missing) if missing else {}
+
+            lines = []
+            for telegram_id, username, first_name, last_name in rows:
+                if telegram_id in profiles:
+                    username, first_name, last_name = profiles[telegram_id]
+                lines.append(format_referral(telegram_id, username, first_name, last_name))
+            message = f"*Friends who have joined us (page {page + 1}):*\n\n" + "\n".join(lines)
+
+            buttons = []
+            if page > 0:
+                buttons.append(InlineKeyboardButton("« Previous", callback_data=f"referrals:{page - 1}"))
+            if has_next:
+                buttons.append(InlineKeyboardButton("Next »", callback_data=f"referrals:{page + 1}"))
+            if buttons:
+                reply_markup = InlineKeyboardMarkup([buttons])
         else:
             message = "*Hmm... Seems like we need more people here.*"
 
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=message, parse_mode="Markdown")
-        logger.info(f"Sent referrals list to user {user_id}")
+        if update.callback_query and update.callback_query.data.startswith("referrals:"):
+            # Page navigation edits the list in place
+            outbox.submit("edit_message_text", update.effective_chat.id, message_id=update.callback_query.message.message_id,
+                          text=message, parse_mode="Markdown", reply_markup=reply_markup)
+        else:
+            outbox.send_message(chat_id=update.effective_chat.id, text=message, parse_mode="Markdown", reply_markup=reply_markup)
+        logger.info("Sent referrals list to user %s", user_id)
 
     except Exception as e:
-        logger.error(f"Error in referrals for user {user_id}: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+        logger.exception("Error in referrals for user %s: %s", user_id, e)
 
 @channel_membership_required
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        logger.info(f"Fetching balance for user {user_id}")
+        logger.info("Fetching balance for user %s", user_id)
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT points_available FROM Users WHERE telegram_id = %s", (user_id,))
-        points = cursor.fetchone()[0]
+        # Include ledger credits that have not been applied to the balance yet
+        points = (await db.fetchone(
+            "SELECT u.points_available + COALESCE((SELECT SUM(c.points) FROM ReferralCredits c WHERE c.referrer_id = u.telegram_id AND c.applied_at IS NULL), 0) "
+            "FROM Users u WHERE u.telegram_id = %s",
+            (user_id,),
+        ))[0]
 
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"*You have a balance of ||{escape_md(f'{points} points.')}||*", parse_mode="MarkdownV2")
-        logger.info(f"Sent balance to user {user_id}")
+        outbox.send_message(chat_id=update.effective_chat.id, text=f"*You have a balance of ||{escape_md(f'{points} points.')}||*", parse_mode="MarkdownV2")
+        logger.info("Sent balance to user %s", user_id)
 
     except Exception as e:
-        logger.error(f"Error in balance for user {user_id}: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+        logger.exception("Error in balance for user %s: %s", user_id, e)
+
+def format_leader(position, username, first_name):
+    if first_name:
+        return escape_markdown(first_name)
+    return escape_markdown(f"@{username}") if username and username != "Unknown" else f"User #{position}"
+
+@channel_membership_required
+async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user_id = update.effective_user.id
+        logger.info("Fetching leaderboard for user %s", user_id)
+
+        top = await leaderboard.snapshot()
+        # A primary key lookup; the rank itself comes from the snapshot
+        count = (await db.fetchone("SELECT successful_referral_count FROM Users WHERE telegram_id = %s", (user_id,)))[0]
+        rank = leaderboard.rank(count)
+
+        if top:
+            lines = [
+                f"{position}. {format_leader(position, username, first_name)} - *{referrals_count}*"
+                for position, (_, username, first_name, referrals_count) in enumerate(top, start=1)
+            ]
+            message = "*Top referrers:*\n\n" + "\n".join(lines)
+        else:
+            message = "*Nobody is on the leaderboard yet. Be the first!*"
+        if rank:
+            message += f"\n\n*You are #{rank} with {count} friends joined.*"
+        else:
+            message += "\n\n*Invite a friend to get on the board.*"
+
+        outbox.send_message(chat_id=update.effective_chat.id, text=message, parse_mode="Markdown")
+        logger.info("Sent leaderboard to user %s", user_id)
+
+    except Exception as e:
+        logger.exception("Error in leaderboard for user %s: %s", user_id, e)
 
 @channel_membership_required
 async def redeem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         if len(context.args) != 1:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="*This is the syntax you must follow:\n/redeem <item-id>*", parse_mode="Markdown")
-            logger.warning(f"Invalid redeem usage by user {update.effective_user.id}")
+            outbox.send_message(chat_id=update.effective_chat.id, text="*This is the syntax you must follow:\n/redeem <item-id>*", parse_mode="Markdown")
+            logger.warning("Invalid redeem usage by user %s", update.effective_user.id)
             return
 
         item_id = context.args[0]
         user_id = update.effective_user.id
-        logger.info(f"Processing redeem request for user {user_id}, item {item_id}")
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        logger.info("Processing redeem request for user %s, item %s", user_id, item_id)
 
-        # Fetch user points
-        cursor.execute("SELECT points_available FROM Users WHERE telegram_id = %s", (user_id,))
-        user_data = cursor.fetchone()
-        if not user_data:
-            logger.error(f"User {user_id} not found in database.")
+        if not item_id.isdigit():
+            outbox.send_message(chat_id=update.effective_chat.id, text="*Sorry, item id seems to be incorrect.*", parse_mode="Markdown", priority=PRIORITY_HIGH)
+            logger.error("Invalid reward ID %s for user %s", item_id, user_id)
             return
 
-        points = user_data[0]
+        # Checks, point deduction and slot claim happen atomically in one round trip
+        status, item_description, secret_1, secret_2 = await db.run(redeem_reward, user_id, int(item_id), transaction=False)
 
-        # Fetch reward details
-        cursor.execute("SELECT item_description, points_required, secret_1, secret_2, redeemed_count, max_count FROM Rewards WHERE item_id = %s", (item_id,))
-        reward = cursor.fetchone()
-
-        if not reward:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="*Sorry, item id seems to be incorrect.*", parse_mode="Markdown")
-            logger.error(f"Invalid reward ID {item_id} for user {user_id}")
+        if status == "unknown_user":
+            logger.error("User %s not found in database.", user_id)
             return
 
-        item_description, points_required, secret_1, secret_2, redeemed_count, max_count = reward
+        if status == "unknown_item":
+            outbox.send_message(chat_id=update.effective_chat.id, text="*Sorry, item id seems to be incorrect.*", parse_mode="Markdown", priority=PRIORITY_HIGH)
+            logger.error("Invalid reward ID %s for user %s", item_id, user_id)
+            return
 
         # Check if reward is still available
-        if redeemed_count >= max_count:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="*Sorry, This reward is no longer available.*", parse_mode="Markdown")
-            logger.warning(f"Reward {item_id} has reached its redemption limit.")
+        if status == "sold_out":
+            catalog.mark_sold_out(int(item_id))
+            outbox.send_message(chat_id=update.effective_chat.id, text="*Sorry, This reward is no longer available.*", parse_mode="Markdown", priority=PRIORITY_HIGH)
+            logger.warning("Reward %s has reached its redemption limit.", item_id)
             return
 
         # Check if user has enough points
-        if points < points_required:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="*Sorry, You don't have enough points to redeem this item.*", parse_mode="Markdown")
-            logger.warning(f"User {user_id} attempted to redeem {item_id} with insufficient points")
+        if status == "insufficient_points":
+            outbox.send_message(chat_id=update.effective_chat.id, text="*Sorry, You don't have enough points to redeem this item.*", parse_mode="Markdown", priority=PRIORITY_HIGH)
+            logger.warning("User %s attempted to redeem %s with insufficient points", user_id, item_id)
             return
 
-        # Deduct points and update redemption count
-        cursor.execute(
-            "UPDATE Users SET points_available = points_available - %s WHERE telegram_id = %s",
-            (points_required, user_id)
-        )
-        cursor.execute(
-            "UPDATE Rewards SET redeemed_count = redeemed_count + 1 WHERE item_id = %s",
-            (item_id,)
-        )
-        conn.commit()
-
-        await context.bot.send_sticker(chat_id=update.effective_chat.id, sticker=STICKER_ID_5)
-        await context.bot.send_message(
+        # Each redemption gets its own credential; secret_2 is optional in the pool
+        credentials = "\n".join(f"||{escape_md(secret)}||" for secret in (secret_1, secret_2) if secret)
+        outbox.send_sticker(chat_id=update.effective_chat.id, sticker=STICKER_ID_5, priority=PRIORITY_HIGH)
+        outbox.send_message(
         chat_id=update.effective_chat.id,
+        priority=PRIORITY_HIGH,
         text=(
             f"*Reward redeemed:\n{escape_md(item_description)}*\n\n"
             f"*Credentials:*\n"
-            f"||{escape_md(secret_1)}||\n"
-            f"||{escape_md(secret_2)}||"
+            f"{credentials}"
         ),
         parse_mode="MarkdownV2"
         )
-        logger.info(f"User {user_id} redeemed reward {item_id}")
+        catalog.record_redemption(int(item_id))
+        logger.info("User %s redeemed reward %s", user_id, item_id)
 
     except Exception as e:
-        logger.error(f"Error in redeem for user {update.effective_user.id}: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+        logger.exception("Error in redeem for user %s: %s", update.effective_user.id, e)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        logger.info(f"Sending help message to user {update.effective_user.id}")
+        logger.info("Sending help message to user %s", update.effective_user.id)
         
         # Sending a sticker (replace with your sticker ID)
-        await context.bot.send_sticker(chat_id=update.effective_chat.id, sticker=STICKER_ID)
+        outbox.send_sticker(chat_id=update.effective_chat.id, sticker=STICKER_ID)
         
         # Sending a brief description about the bot
         description = (
@@ -392,23 +1034,23 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         # Send the message with the description and buttons
-        await context.bot.send_message(
+        outbox.send_message(
             chat_id=update.effective_chat.id,
             text=description,
             parse_mode="Markdown",
             reply_markup=reply_markup
         )
         
-        logger.info(f"Help message sent to user {update.effective_user.id}")
+        logger.info("Help message sent to user %s", update.effective_user.id)
     except Exception as e:
-        logger.error(f"Error in help_command for user {update.effective_user.id}: {e}", exc_info=True)
+        logger.exception("Error in help_command for user %s: %s", update.effective_user.id, e)
 
 async def handle_menu_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
         await query.answer()  # Acknowledge the button press
         user_id = update.effective_user.id
-        logger.info(f"User {user_id} selected menu option: {query.data}")
+        logger.info("User %s selected menu option: %s", user_id, query.data)
 
         # Route based on callback_data
         if query.data == "rewards":
@@ -417,45 +1059,106 @@ async def handle_menu_selection(update: Update, context: ContextTypes.DEFAULT_TY
             await get_link(update, context)
         elif query.data == "referrals":
             await referrals(update, context)
+        elif query.data.startswith("rewards:"):
+            await handle_rewards(update, context, page=int(query.data.split(":", 1)[1]))
+        elif query.data.startswith("referrals:"):
+            await referrals(update, context, page=int(query.data.split(":", 1)[1]))
         elif query.data == "balance":
             await balance(update, context)
+        elif query.data == "leaderboard":
+            await show_leaderboard(update, context)
         elif query.data == "redeem":
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="*Use /redeem <item-id> to redeem a reward.*", parse_mode="Markdown")
+            outbox.send_message(chat_id=update.effective_chat.id, text="*Use /redeem <item-id> to redeem a reward.*", parse_mode="Markdown")
         elif query.data == "help":
             await help_command(update, context)
         else:
-            await query.edit_message_text(text="Invalid option. Please try again.")
+            outbox.submit("edit_message_text", update.effective_chat.id, message_id=query.message.message_id,
+                          text="Invalid option. Please try again.")
     except Exception as e:
-        logger.error(f"Error in handle_menu_selection for user {update.effective_user.id}: {e}")
-        await update.callback_query.message.reply_text("An error occurred while processing your selection. Please try again later.")
-
-# Update main entry point to include the callback query handler
-if __name__ == "__main__":
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+        logger.exception("Error in handle_menu_selection for user %s: %s", update.effective_user.id, e)
+        outbox.send_message(chat_id=update.effective_chat.id, text="An error occurred while processing your selection. Please try again later.")
+
+def timed(name, callback):
+    return instrument_handler(name, callback, sample_rate=TRACE_SAMPLE_RATE)
+
+def build_application(updater=True, worker_count=1, worker_index=0, base_url=None, send_budget=None):
+    setup_logging()
+    builder = (
+        ApplicationBuilder()
+        .application_class(OrderedApplication)
+        .token(BOT_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        # Used by the load tests to talk to a local fake Bot API
+        builder = builder.base_url(base_url)
+    if not updater:
+        # Webhook workers are fed updates by the front end
+        builder = builder.updater(None)
+    application = builder.build()
+    application.bot_data["worker_index"] = worker_index
+
+    if send_budget is not None:
+        # Workers draw on one global send limit, so a worker running a broadcast
+        # can use whatever the others leave idle
+        outbox.share_global_rate(send_budget)
+    elif worker_count > 1:
+        outbox.set_global_rate(OUTBOX_GLOBAL_RATE / worker_count)
 
     # Command handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("rewards", channel_membership_required(handle_rewards)))
-    application.add_handler(CommandHandler("get_link", channel_membership_required(get_link)))
-    application.add_handler(CommandHandler("referrals", channel_membership_required(referrals)))
-    application.add_handler(CommandHandler("balance", channel_membership_required(balance)))
-    application.add_handler(CommandHandler("redeem", channel_membership_required(redeem)))
-    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("start", timed("start", start)))
+    application.add_handler(CommandHandler("rewards", timed("rewards", handle_rewards)))
+    application.add_handler(CommandHandler("get_link", timed("get_link", get_link)))
+    application.add_handler(CommandHandler("referrals", timed("referrals", referrals)))
+    application.add_handler(CommandHandler("balance", timed("balance", balance)))
+    application.add_handler(CommandHandler("leaderboard", timed("leaderboard", show_leaderboard)))
+    application.add_handler(CommandHandler("redeem", timed("redeem", redeem)))
+    application.add_handler(CommandHandler("help", timed("help", help_command)))
+
+    # Admin commands
+    application.add_handler(CommandHandler("reload_rewards", timed("reload_rewards", reload_rewards)))
+    application.add_handler(CommandHandler("broadcast", timed("broadcast", broadcast)))
+    application.add_handler(CommandHandler("broadcast_cancel", timed("broadcast_cancel", broadcast_cancel)))
+    application.add_handler(CommandHandler("referral_report", timed("referral_report", referral_report)))
+
+    # Keep the membership cache in sync with joins/leaves in the target channel
+    application.add_handler(ChatMemberHandler(timed("chat_member", track_channel_membership), ChatMemberHandler.CHAT_MEMBER))
+
+    # Remember who blocked the bot so broadcasts skip them
+    application.add_handler(ChatMemberHandler(timed("my_chat_member", track_bot_blocked), ChatMemberHandler.MY_CHAT_MEMBER))
 
     # Callback query handler for menu buttons
-    application.add_handler(CallbackQueryHandler(handle_menu_selection))
+    application.add_handler(CallbackQueryHandler(timed("menu", handle_menu_selection)))
 
     # Fallback handler for unknown messages
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, fallback))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed("fallback", fallback)))
+
+    return application
 
+if __name__ == "__main__":
     logger.info("Bot started.")
 
     # Catch all runtime errors and display a custom message
     try:
-        application.run_polling()
+        if BOT_MODE == "webhook":
+            run_webhook(
+                functools.partial(build_application, send_budget=SharedTokenBucket.shared_state()),
+                token=BOT_TOKEN,
+                url=WEBHOOK_URL,
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                path=WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                workers=WEBHOOK_WORKERS,
+            )
+        else:
+            # chat_member updates are only delivered when explicitly requested
+            build_application().run_polling(allowed_updates=Update.ALL_TYPES)
     except TelegramError as te:
-        logger.error(f"A Telegram API error occurred: {te}")
+        logger.exception("A Telegram API error occurred: %s", te)
     except Exception as e:
-        logger.error(f"An unexpected error occurred: {e}")
+        logger.exception("An unexpected error occurred: %s", e)
     finally:
         logger.info("Bot stopped.")
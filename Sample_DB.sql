@@ -6,10 +6,22 @@ USE Referral_Data;
 CREATE TABLE Users (
     telegram_id BIGINT PRIMARY KEY,
     username VARCHAR(255) NOT NULL,
+    first_name VARCHAR(255) DEFAULT NULL,
+    last_name VARCHAR(255) DEFAULT NULL,
     referred_by BIGINT DEFAULT NULL, 
     points_available INT DEFAULT 0,
     is_joined BOOLEAN NOT NULL,
     points_credited BOOLEAN DEFAULT FALSE,
+    is_blocked BOOLEAN NOT NULL DEFAULT FALSE,
+    membership_checked_at TIMESTAMP NULL DEFAULT NULL,
+    referral_count INT NOT NULL DEFAULT 0, -- users who started the bot through this user's link
+    successful_referral_count INT NOT NULL DEFAULT 0, -- of those, how many joined and were credited
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_users_broadcast (is_joined, is_blocked, telegram_id),
+    INDEX idx_users_membership_checked (membership_checked_at),
+    INDEX idx_users_referred_by (referred_by, telegram_id),
+    INDEX idx_users_leaderboard (successful_referral_count, telegram_id),
+    INDEX idx_users_created (created_at),
     FOREIGN KEY (referred_by) REFERENCES Users(telegram_id) ON DELETE SET NULL -- Referencing the same table for the referral
 );
 
@@ -18,35 +30,158 @@ CREATE TABLE Rewards (
     item_id INT PRIMARY KEY,
     item_description VARCHAR(255) NOT NULL,
     points_required INT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Credential pool: one row per redeemable slot, claimed by redeem_reward
+CREATE TABLE RewardCredentials (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    item_id INT NOT NULL,
     secret_1 VARCHAR(255) NOT NULL,
-    secret_2 VARCHAR(255)NOT NULL,
-    redeemed_count INT DEFAULT 0,
-    max_count INT DEFAULT 0
+    secret_2 VARCHAR(255) NOT NULL DEFAULT '',
+    redeemed_by BIGINT DEFAULT NULL,
+    redeemed_at TIMESTAMP NULL DEFAULT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_reward_credential (item_id, secret_1, secret_2),
+    KEY idx_reward_credential_available (item_id, redeemed_by, id),
+    KEY idx_reward_credential_redeemed_at (redeemed_at),
+    FOREIGN KEY (item_id) REFERENCES Rewards(item_id) ON DELETE CASCADE
+);
+
+-- Referral credits ledger; rows are applied to Users.points_available in batches
+CREATE TABLE ReferralCredits (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    referrer_id BIGINT NOT NULL,
+    referee_id BIGINT NOT NULL,
+    points INT NOT NULL,
+    level TINYINT NOT NULL DEFAULT 1, -- 1 for the direct referrer, 2 for their referrer, ...
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    applied_at TIMESTAMP NULL DEFAULT NULL,
+    UNIQUE KEY uq_referral_credit_referee (referee_id, level),
+    KEY idx_referral_credit_pending (applied_at, id),
+    KEY idx_referral_credit_referrer (referrer_id, applied_at)
+);
+
+-- Admin broadcasts; last_telegram_id is the keyset checkpoint used to resume
+CREATE TABLE Broadcasts (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    admin_id BIGINT NOT NULL,
+    message TEXT NOT NULL,
+    status ENUM('running', 'done', 'cancelled') NOT NULL DEFAULT 'running',
+    last_telegram_id BIGINT NOT NULL DEFAULT 0,
+    total INT NOT NULL DEFAULT 0,
+    sent INT NOT NULL DEFAULT 0,
+    failed INT NOT NULL DEFAULT 0,
+    blocked INT NOT NULL DEFAULT 0,
+    progress_message_id BIGINT DEFAULT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_broadcasts_status (status)
 );
 
 -- Data insertion for rewards
-INSERT INTO Rewards (item_id, item_description, points_required, secret_1, secret_2, redeemed_count, max_count) 
+INSERT INTO Rewards (item_id, item_description, points_required) 
 VALUES
-(401, 'E-Book Reader Subscription - 1 Year', 200, 'user001@library.com', 'Key!Read2023', 0, 10),
-(402, 'Music Streaming Service - 6 Month Plan', 150, 'user002@musicstream.com', 'Tune#Safe789', 1, 8),
-(403, 'Online Fitness Plan - 3 Months', 100, 'user003@fitmail.com', 'Workout@123', 2, 7),
-(404, 'Coding Bootcamp Voucher', 250, 'user004@eduportal.com', 'Code@Master', 0, 5),
-(405, 'Photo Editing Software - Annual License', 300, 'user005@photoapp.com', 'EditPro@2024', 0, 3),
-(406, 'VPN Service - Lifetime Access', 400, 'user006@securevpn.com', 'SecureVPN#1', 1, 2),
-(407, 'Language Learning Subscription - 1 Year', 180, 'user007@langlearn.com', 'LangPro2023!', 0, 6),
-(408, 'Secure Storage - 2 Year Plan', 350, 'user008@cloudservice.com', 'Storage#Safe', 0, 3),
-(409, 'Gaming Service Pass - 1 Year', 500, 'user009@gamepass.com', 'GameOn@500', 0, 2),
-(410, 'Digital Magazine - 6 Month Access', 120, 'user010@magazine.com', 'Mag6Months@Key', 0, 7);
+(401, 'E-Book Reader Subscription - 1 Year', 200),
+(402, 'Music Streaming Service - 6 Month Plan', 150),
+(403, 'Online Fitness Plan - 3 Months', 100),
+(404, 'Coding Bootcamp Voucher', 250),
+(405, 'Photo Editing Software - Annual License', 300),
+(406, 'VPN Service - Lifetime Access', 400),
+(407, 'Language Learning Subscription - 1 Year', 180),
+(408, 'Secure Storage - 2 Year Plan', 350),
+(409, 'Gaming Service Pass - 1 Year', 500),
+(410, 'Digital Magazine - 6 Month Access', 120);
+
+-- Credentials for the rewards above; bulk restocks go through import_credentials.py
+INSERT INTO RewardCredentials (item_id, secret_1, secret_2) 
+VALUES
+(401, 'user001.1@library.com', 'Key!Read20231'),
+(401, 'user001.2@library.com', 'Key!Read20232'),
+(402, 'user002.1@musicstream.com', 'Tune#Safe7891'),
+(402, 'user002.2@musicstream.com', 'Tune#Safe7892'),
+(403, 'user003.1@fitmail.com', 'Workout@1231'),
+(403, 'user003.2@fitmail.com', 'Workout@1232'),
+(404, 'user004.1@eduportal.com', 'Code@Master1'),
+(404, 'user004.2@eduportal.com', 'Code@Master2'),
+(405, 'user005.1@photoapp.com', 'EditPro@20241'),
+(405, 'user005.2@photoapp.com', 'EditPro@20242'),
+(406, 'user006.1@securevpn.com', 'SecureVPN#11'),
+(406, 'user006.2@securevpn.com', 'SecureVPN#12'),
+(407, 'user007.1@langlearn.com', 'LangPro2023!1'),
+(407, 'user007.2@langlearn.com', 'LangPro2023!2'),
+(408, 'user008.1@cloudservice.com', 'Storage#Safe1'),
+(408, 'user008.2@cloudservice.com', 'Storage#Safe2'),
+(409, 'user009.1@gamepass.com', 'GameOn@5001'),
+(409, 'user009.2@gamepass.com', 'GameOn@5002'),
+(410, 'user010.1@magazine.com', 'Mag6Months@Key1'),
+(410, 'user010.2@magazine.com', 'Mag6Months@Key2');
 
 -- Data insertion for users
-INSERT INTO users (telegram_id, username, referred_by, points_available, is_joined, points_credited) 
+INSERT INTO users (telegram_id, username, referred_by, points_available, is_joined, points_credited, referral_count, successful_referral_count) 
 VALUES 
-(876543210, 'UserOmega', NULL, 1200, 1, 1),
-(987654321, 'UserSigma', 876543210, 800, 1, 0),
-(123456789, 'UserAlpha', NULL, 1500, 1, 1),
-(234567890, 'UserBeta', 123456789, 600, 1, 0),
-(345678901, 'UserGamma', 987654321, 900, 1, 1);
+(876543210, 'UserOmega', NULL, 1200, 1, 1, 1, 0),
+(987654321, 'UserSigma', 876543210, 800, 1, 0, 1, 1),
+(123456789, 'UserAlpha', NULL, 1500, 1, 1, 1, 0),
+(234567890, 'UserBeta', 123456789, 600, 1, 0, 0, 0),
+(345678901, 'UserGamma', 987654321, 900, 1, 1, 0, 0);
+
+-- Atomic, single round trip redemption (see RefBot.redeem_reward)
+DELIMITER //
+CREATE PROCEDURE redeem_reward(IN p_user_id BIGINT, IN p_item_id INT)
+BEGIN
+    DECLARE v_points_required INT DEFAULT NULL;
+    DECLARE v_credential_id BIGINT DEFAULT NULL;
+    DECLARE v_status VARCHAR(32) DEFAULT 'ok';
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    SELECT points_required INTO v_points_required FROM Rewards WHERE item_id = p_item_id;
 
+    IF v_points_required IS NULL THEN
+        SET v_status = 'unknown_item';
+    ELSE
+        -- Deduct first: it locks only the caller's row, so users without enough
+        -- points never hold a credential. The condition keeps balances non-negative
+        UPDATE Users
+        SET points_available = points_available - v_points_required
+        WHERE telegram_id = p_user_id AND points_available >= v_points_required;
 
+        IF ROW_COUNT() = 0 THEN
+            SET v_status = IF(EXISTS (SELECT 1 FROM Users WHERE telegram_id = p_user_id), 'insufficient_points', 'unknown_user');
+        ELSE
+            -- Claim one unused credential; rows locked by concurrent redeemers are skipped
+            -- instead of waited on, so a flash sale does not queue on a single row
+            SELECT id INTO v_credential_id
+            FROM RewardCredentials
+            WHERE item_id = p_item_id AND redeemed_by IS NULL
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED;
 
+            IF v_credential_id IS NULL THEN
+                -- Rolled back below, which refunds the deduction
+                SET v_status = 'sold_out';
+            ELSE
+                UPDATE RewardCredentials
+                SET redeemed_by = p_user_id, redeemed_at = CURRENT_TIMESTAMP
+                WHERE id = v_credential_id;
+            END IF;
+        END IF;
+    END IF;
 
+    IF v_status = 'ok' THEN
+        COMMIT;
+        SELECT v_status AS status, r.item_description, c.secret_1, c.secret_2
+        FROM RewardCredentials c JOIN Rewards r ON r.item_id = c.item_id
+        WHERE c.id = v_credential_id;
+    ELSE
+        ROLLBACK;
+        SELECT v_status AS status, NULL AS item_description, NULL AS secret_1, NULL AS secret_2;
+    END IF;
+END //
+DELIMITER ;
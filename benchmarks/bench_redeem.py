@@ -0,0 +1,126 @@
+"""Flash-redemption stress test for the redeem_reward procedure.
+
+Creates a throwaway reward and a batch of users funded for one redemption
+each in the database from .env, fires concurrent redeems at the one item and
+checks that every successful redeem claimed exactly one credential, that no
+user got two and that no balance went negative. Everything it creates is
+removed afterwards.
+
+    python benchmarks/bench_redeem.py --redeems 500 --slots 3
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Database
+from import_credentials import db_config
+
+BENCH_ITEM_ID = 999001
+BENCH_USER_BASE = 9_000_000_000_000
+
+
+def setup(cursor, users, slots, points_required):
+    cursor.execute(
+        "INSERT INTO Rewards (item_id, item_description, points_required) VALUES (%s, 'Benchmark item', %s)",
+        (BENCH_ITEM_ID, points_required),
+    )
+    cursor.executemany(
+        "INSERT INTO RewardCredentials (item_id, secret_1, secret_2) VALUES (%s, %s, 'bench')",
+        [(BENCH_ITEM_ID, f"bench{i}") for i in range(slots)],
+    )
+    cursor.executemany(
+        "INSERT INTO Users (telegram_id, username, points_available, is_joined) VALUES (%s, 'bench', %s, TRUE)",
+        [(BENCH_USER_BASE + i, points_required) for i in range(users)],
+    )
+
+
+def teardown(cursor, users):
+    cursor.execute("DELETE FROM Users WHERE telegram_id BETWEEN %s AND %s", (BENCH_USER_BASE, BENCH_USER_BASE + users))
+    cursor.execute("DELETE FROM Rewards WHERE item_id = %s", (BENCH_ITEM_ID,))
+
+
+def redeem_reward(cursor, user_id, item_id):
+    # Same call as RefBot.redeem_reward; importing RefBot would run the bot's module setup
+    cursor.callproc("redeem_reward", (user_id, item_id))
+    for result in cursor.stored_results():
+        return result.fetchone()
+
+
+def collect(cursor, users):
+    cursor.execute(
+        "SELECT COUNT(redeemed_by), COUNT(DISTINCT redeemed_by), COUNT(*) FROM RewardCredentials WHERE item_id = %s",
+        (BENCH_ITEM_ID,),
+    )
+    redeemed_count, redeemers, max_count = cursor.fetchone()
+    cursor.execute(
+        "SELECT COUNT(*), COALESCE(SUM(points_available < 0), 0) FROM Users WHERE telegram_id BETWEEN %s AND %s",
+        (BENCH_USER_BASE, BENCH_USER_BASE + users),
+    )
+    _, negative = cursor.fetchone()
+    return redeemed_count, redeemers, max_count, negative
+
+
+async def timed_redeem(db, user_id):
+    started = time.perf_counter()
+    row = await db.run(redeem_reward, user_id, BENCH_ITEM_ID, transaction=False)
+    return row[0], time.perf_counter() - started
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def main(args):
+    db = Database(db_config(), pool_size=args.pool_size, pool_name="bench_redeem")
+    db.open()
+    await db.run(teardown, args.users)
+    await db.run(setup, args.users, args.slots, args.points)
+    try:
+        # Users redeem more than once when --redeems exceeds --users; having points
+        # for only one, their second attempt exercises the insufficient-points path
+        user_ids = [BENCH_USER_BASE + (i % args.users) for i in range(args.redeems)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*(timed_redeem(db, user_id) for user_id in user_ids))
+        elapsed = time.perf_counter() - started
+
+        statuses = {}
+        for status, _ in results:
+            statuses[status] = statuses.get(status, 0) + 1
+        latencies = sorted(latency for _, latency in results)
+        redeemed_count, redeemers, max_count, negative = await db.run(collect, args.users)
+
+        print(f"redeems:      {args.redeems} against {args.slots} slots ({args.pool_size} connections)")
+        print(f"statuses:     {statuses}")
+        print(f"throughput:   {args.redeems / elapsed:.1f} redeems/s")
+        print(f"latency:      p50={percentile(latencies, 0.50) * 1000:.1f}ms "
+              f"p99={percentile(latencies, 0.99) * 1000:.1f}ms max={latencies[-1] * 1000:.1f}ms")
+        print(f"redeemed:     {redeemed_count}/{max_count}")
+
+        ok = statuses.get("ok", 0)
+        failures = []
+        if ok != redeemed_count:
+            failures.append(f"{ok} successful redeems but {redeemed_count} credentials claimed")
+        if redeemers != redeemed_count:
+            failures.append(f"{redeemed_count - redeemers} users claimed more than one credential")
+        if negative:
+            failures.append(f"{negative} users with a negative balance")
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        return 1 if failures else 0
+    finally:
+        await db.run(teardown, args.users)
+        await db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redeems", type=int, default=500, help="concurrent redeem calls to fire")
+    parser.add_argument("--users", type=int, default=400, help="distinct funded users")
+    parser.add_argument("--slots", type=int, default=3, help="credentials in the benchmark item's pool")
+    parser.add_argument("--points", type=int, default=100, help="points_required of the benchmark item")
+    parser.add_argument("--pool-size", type=int, default=32, help="database connections")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,143 @@
+"""Minimal local stand-in for the Telegram Bot API.
+
+Answers the methods InvitePal uses (getMe, getChatMember, getChat,
+sendMessage, sendSticker, editMessageText, answerCallbackQuery, ...) with
+configurable latency and injected 429 responses, and counts calls per method.
+Point the bot at it with ``base_url=server.base_url``.
+
+Run standalone with ``python benchmarks/fake_bot_api.py --port 8081``.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from urllib.parse import parse_qs
+
+
+class FakeBotAPI:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, rate_limit_ratio=0.0, retry_after=1,
+                 member_ratio=1.0, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.member_ratio = member_ratio
+        self.calls = {}
+        self.rate_limited = {}
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._server = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            # Keep-alive loop: httpx reuses connections
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = request_line.split()[1].decode()
+                status, payload = await self._handle(path.rsplit("/", 1)[-1], _parse_body(headers, body))
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        if method != "getMe" and self._random.random() < self.rate_limit_ratio:
+            self.rate_limited[method] = self.rate_limited.get(method, 0) + 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        return 200, {"ok": True, "result": self._result(method, params)}
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "InvitePal", "username": "invitepal_bench_bot",
+                    "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method == "getChatMember":
+            user_id = int(params.get("user_id", 0))
+            status = "member" if self._random.random() < self.member_ratio else "left"
+            return {"status": status, "user": _user(user_id)}
+        if method == "getChat":
+            chat_id = int(params.get("chat_id", 0))
+            return {"id": chat_id, "type": "private", "first_name": f"User{chat_id}", "username": f"user{chat_id}"}
+        if method in ("sendMessage", "sendSticker", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                       "chat": {"id": chat_id, "type": "private"}}
+            if "text" in params:
+                message["text"] = params["text"]
+            return message
+        return True
+
+    def summary(self):
+        return {"calls": dict(self.calls), "rate_limited": dict(self.rate_limited)}
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def _parse_body(headers, body):
+    content_type = headers.get("content-type", "")
+    if "application/json" in content_type:
+        return json.loads(body or b"{}")
+    return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+
+async def _serve_forever(args):
+    api = await FakeBotAPI(port=args.port, latency=args.latency, jitter=args.jitter,
+                           rate_limit_ratio=args.rate_limit_ratio).start()
+    print(f"Fake Bot API listening on {api.base_url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, up to this many seconds")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of calls answered with 429")
+    try:
+        asyncio.run(_serve_forever(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
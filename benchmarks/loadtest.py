@@ -0,0 +1,195 @@
+"""Offline load test: replays synthetic update streams through the real handlers.
+
+Telegram is replaced by benchmarks/fake_bot_api.py. The database is the one
+configured in .env; point it at a local test instance. Seeded users live in
+a reserved id range and are removed afterwards.
+
+Scenarios:
+  start_storm   new users sending /start <referrer_id>
+  balance_spam  existing users hammering /balance
+  redeem_rush   existing users sending /redeem for one scarce item
+
+    python benchmarks/loadtest.py --updates 2000 --latency 0.05 --rate-limit-ratio 0.01
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Must be in place before RefBot reads its configuration
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ.setdefault("BOT_USERNAME", "invitepal_bench_bot")
+os.environ.setdefault("TARGET_CHANNEL", "@invitepal_bench")
+
+from fake_bot_api import FakeBotAPI
+
+SCENARIOS = ("start_storm", "balance_spam", "redeem_rush")
+SEED_BASE = 9_100_000_000_000
+NEW_USER_BASE = 9_200_000_000_000
+BENCH_ITEM_ID = 999002
+
+
+def seed(cursor, users, slots):
+    cursor.executemany(
+        "INSERT INTO Users (telegram_id, username, first_name, points_available, is_joined, points_credited) "
+        "VALUES (%s, %s, %s, 1000, TRUE, TRUE)",
+        [(SEED_BASE + i, f"seed{i}", f"Seed{i}") for i in range(users)],
+    )
+    cursor.execute(
+        "INSERT INTO Rewards (item_id, item_description, points_required) VALUES (%s, 'Load test item', 100)",
+        (BENCH_ITEM_ID,),
+    )
+    cursor.executemany(
+        "INSERT INTO RewardCredentials (item_id, secret_1, secret_2) VALUES (%s, %s, 'bench')",
+        [(BENCH_ITEM_ID, f"bench{i}") for i in range(slots)],
+    )
+
+
+def cleanup(cursor):
+    ranges = (SEED_BASE, NEW_USER_BASE + 10**12)
+    cursor.execute("DELETE FROM ReferralCredits WHERE referrer_id BETWEEN %s AND %s OR referee_id BETWEEN %s AND %s", ranges * 2)
+    cursor.execute("DELETE FROM Users WHERE telegram_id BETWEEN %s AND %s", ranges)
+    cursor.execute("DELETE FROM Rewards WHERE item_id = %s", (BENCH_ITEM_ID,))
+
+
+async def start_bot(RefBot, application):
+    # Only what the handlers need. post_init would also resume running broadcasts,
+    # reconcile memberships against the fake API (which reports everyone as a
+    # member) and apply pending referral credits in the configured database
+    await asyncio.get_running_loop().run_in_executor(None, RefBot.db.open)
+    RefBot.outbox.start(application.bot)
+    RefBot.membership_tracker.start(application.bot, reconcile=False, on_join=RefBot.credit_new_members)
+
+
+async def drain_bot(RefBot):
+    # drain_pending_work without the broadcast and ledger steps
+    await RefBot.update_scheduler.join()
+    await RefBot.membership_tracker.stop()
+    for referrer_id in list(RefBot.pending_referral_notices):
+        RefBot.flush_referral_notice(referrer_id)
+    await RefBot.outbox.stop()
+
+
+def command_update(update_id, user_id, text):
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+def build_stream(scenarios, updates, seeded_users, rng):
+    update_ids = itertools.count(1)
+    new_users = itertools.count()
+    stream = []
+    for i in range(updates):
+        scenario = scenarios[i % len(scenarios)]
+        if scenario == "start_storm":
+            referrer = SEED_BASE + rng.randrange(seeded_users)
+            stream.append(("start", command_update(next(update_ids), NEW_USER_BASE + next(new_users), f"/start {referrer}")))
+        elif scenario == "balance_spam":
+            # A small hot set of users, like a handful of scripted accounts
+            user_id = SEED_BASE + rng.randrange(min(20, seeded_users))
+            stream.append(("balance", command_update(next(update_ids), user_id, "/balance")))
+        else:
+            user_id = SEED_BASE + rng.randrange(seeded_users)
+            stream.append(("redeem", command_update(next(update_ids), user_id, f"/redeem {BENCH_ITEM_ID}")))
+    return stream
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def main(args):
+    os.environ.setdefault("OUTBOX_GLOBAL_RATE", str(args.send_rate))
+    os.environ.setdefault("OUTBOX_CHAT_RATE", str(args.send_rate))
+    os.environ.setdefault("OUTBOX_CHAT_BURST", str(int(args.send_rate)))
+    import RefBot
+    from telegram import Update
+    from telegram.ext import Application
+
+    api = await FakeBotAPI(latency=args.latency, jitter=args.jitter, rate_limit_ratio=args.rate_limit_ratio,
+                           seed=args.seed).start()
+    application = RefBot.build_application(updater=False, base_url=api.base_url)
+    await application.initialize()
+    await start_bot(RefBot, application)
+    await RefBot.db.run(cleanup)
+    await RefBot.db.run(seed, args.seeded_users, args.slots)
+
+    rng = random.Random(args.seed)
+    stream = build_stream(args.scenarios, args.updates, args.seeded_users, rng)
+    latencies = {}
+    loop = asyncio.get_running_loop()
+
+    async def feed(handler, data):
+        update = Update.de_json(data, application.bot)
+        enqueued = time.perf_counter()
+        done = loop.create_future()
+
+        async def job():
+            try:
+                await Application.process_update(application, update)
+            finally:
+                latencies.setdefault(handler, []).append(time.perf_counter() - enqueued)
+                done.set_result(None)
+
+        await RefBot.update_scheduler.submit(RefBot.update_key(update), job)
+        return done
+
+    try:
+        started = time.perf_counter()
+        pending = [await feed(handler, data) for handler, data in stream]
+        await asyncio.gather(*pending)
+        processed = time.perf_counter() - started
+        await drain_bot(RefBot)
+        delivered = time.perf_counter() - started
+
+        print(f"updates:     {len(stream)} ({', '.join(args.scenarios)})")
+        print(f"throughput:  {len(stream) / processed:.1f} updates/s handled, "
+              f"{len(stream) / delivered:.1f} updates/s including outbound delivery")
+        for handler, values in sorted(latencies.items()):
+            values.sort()
+            print(f"{handler:<12} n={len(values):<6} p50={percentile(values, 0.50) * 1000:7.1f}ms "
+                  f"p95={percentile(values, 0.95) * 1000:7.1f}ms p99={percentile(values, 0.99) * 1000:7.1f}ms")
+        outbox = RefBot.outbox.metrics()
+        print(f"outbox:      sent={outbox['sent']} merged={outbox['merged']} retried={outbox['retried']} "
+              f"failed={outbox['failed']} p99={outbox['latency_p99'] * 1000:.1f}ms")
+        print(f"fake api:    {api.summary()}")
+    finally:
+        await RefBot.db.run(cleanup)
+        await application.post_shutdown(application)
+        await application.shutdown()
+        await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=list(SCENARIOS),
+                        help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--updates", type=int, default=2000, help="total updates to replay")
+    parser.add_argument("--seeded-users", type=int, default=200, help="existing users to seed")
+    parser.add_argument("--slots", type=int, default=5, help="credentials in the redeem_rush item's pool")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Bot API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="extra random fake API latency in seconds")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of API calls answered with 429")
+    parser.add_argument("--send-rate", type=float, default=10000,
+                        help="outbox messages/s; raise it to measure the bot rather than Telegram's limits")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    asyncio.run(main(args))
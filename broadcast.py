@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+
+from outbox import PRIORITY_LOW, is_unreachable
+
+logger = logging.getLogger(__name__)
+
+RECIPIENTS_QUERY = (
+    "SELECT telegram_id FROM Users WHERE is_joined = TRUE AND is_blocked = FALSE AND telegram_id > %s "
+    "ORDER BY telegram_id LIMIT %s"
+)
+
+
+def _create(cursor, admin_id, text):
+    cursor.execute("SELECT COUNT(*) FROM Users WHERE is_joined = TRUE AND is_blocked = FALSE")
+    total = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO Broadcasts (admin_id, message, total) VALUES (%s, %s, %s)", (admin_id, text, total))
+    return cursor.lastrowid, total
+
+
+def _checkpoint(cursor, broadcast_id, last_id, sent, failed, blocked_ids):
+    if blocked_ids:
+        cursor.execute(
+            f"UPDATE Users SET is_blocked = TRUE WHERE telegram_id IN ({', '.join(['%s'] * len(blocked_ids))})",
+            blocked_ids,
+        )
+    cursor.execute(
+        "UPDATE Broadcasts SET last_telegram_id = %s, sent = sent + %s, failed = failed + %s, blocked = blocked + %s "
+        "WHERE id = %s AND status = 'running'",
+        (last_id, sent, failed, len(blocked_ids), broadcast_id),
+    )
+    # Zero rows means the broadcast was cancelled meanwhile
+    return cursor.rowcount > 0
+
+
+class Broadcaster:
+    """Streams a message to every joined, non-blocked user.
+
+    Recipients are read in keyset pages ordered by telegram_id. Progress is
+    checkpointed after every page, so a restarted bot resumes after the last
+    finished page (at most one page can be sent twice). Sending goes through
+    the outbox at low priority, i.e. as fast as the rate limits allow without
+    delaying interactive replies.
+    """
+
+    def __init__(self, db, outbox, batch_size=100, progress_interval=10):
+        self.db = db
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self._tasks = {}
+
+    async def start(self, admin_id, text):
+        broadcast_id, total = await self.db.run(_create, admin_id, text)
+        logger.info("Broadcast %s to %s users started by admin %s.", broadcast_id, total, admin_id)
+        self._launch(broadcast_id, admin_id, text, 0, 0, 0, 0, total, None)
+        return broadcast_id, total
+
+    async def resume(self):
+        rows = await self.db.fetchall(
+            "SELECT id, admin_id, message, last_telegram_id, sent, failed, blocked, total, progress_message_id "
+            "FROM Broadcasts WHERE status = 'running'"
+        )
+        for row in rows:
+            if row[0] not in self._tasks:
+                logger.info("Resuming broadcast %s after user %s.", row[0], row[3])
+                self._launch(*row)
+        return len(rows)
+
+    async def cancel(self, broadcast_id):
+        return await self.db.execute(
+            "UPDATE Broadcasts SET status = 'cancelled' WHERE id = %s AND status = 'running'", (broadcast_id,)
+        )
+
+    async def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _launch(self, *state):
+        task = asyncio.get_running_loop().create_task(self._run(*state))
+        self._tasks[state[0]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(state[0], None))
+
+    async def _run(self, broadcast_id, admin_id, text, last_id, sent, failed, blocked, total, progress_message_id):
+        progress = _Progress(self.outbox, broadcast_id, admin_id, total, (sent, failed, blocked), progress_message_id)
+        await progress.open(self.db)
+        try:
+            while True:
+                rows = await self.db.fetchall(RECIPIENTS_QUERY, (last_id, self.batch_size))
+                if not rows:
+                    await self.db.execute("UPDATE Broadcasts SET status = 'done' WHERE id = %s AND status = 'running'", (broadcast_id,))
+                    break
+                recipients = [row[0] for row in rows]
+                results = await asyncio.gather(
+                    *(self.outbox.send_message(chat_id=user_id, text=text, priority=PRIORITY_LOW) for user_id in recipients),
+                    return_exceptions=True,
+                )
+                batch_sent, batch_failed, blocked_ids = 0, 0, []
+                for user_id, result in zip(recipients, results):
+                    if not isinstance(result, Exception):
+                        batch_sent += 1
+                    elif is_unreachable(result):
+                        blocked_ids.append(user_id)
+                    else:
+                        batch_failed += 1
+                last_id = recipients[-1]
+                if not await self.db.run(_checkpoint, broadcast_id, last_id, batch_sent, batch_failed, blocked_ids):
+                    logger.info("Broadcast %s cancelled.", broadcast_id)
+                    progress.update(sent, failed, blocked, final="cancelled")
+                    return
+                sent += batch_sent
+                failed += batch_failed
+                blocked += len(blocked_ids)
+                progress.update(sent, failed, blocked, interval=self.progress_interval)
+            progress.update(sent, failed, blocked, final="finished")
+            logger.info("Broadcast %s finished: sent=%s failed=%s blocked=%s.", broadcast_id, sent, failed, blocked)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Broadcast %s stopped after user %s: %s", broadcast_id, last_id, e)
+
+
+class _Progress:
+    """Live progress message in the admin's chat, edited at most every few seconds."""
+
+    def __init__(self, outbox, broadcast_id, admin_id, total, counts, message_id):
+        self.outbox = outbox
+        self.broadcast_id = broadcast_id
+        self.admin_id = admin_id
+        self.total = total
+        self.message_id = message_id
+        self._counts = counts
+        self._done_before = sum(counts)
+        self._started = time.monotonic()
+        self._updated = 0.0
+
+    async def open(self, db):
+        if self.message_id:
+            return
+        try:
+            message = await self.outbox.send_message(chat_id=self.admin_id, text=self._text(self._done_before, *self._counts))
+            self.message_id = message.message_id
+            await db.execute("UPDATE Broadcasts SET progress_message_id = %s WHERE id = %s", (self.message_id, self.broadcast_id))
+        except Exception as e:
+            logger.exception("Could not post progress for broadcast %s: %s", self.broadcast_id, e)
+
+    def update(self, sent, failed, blocked, interval=0, final=None):
+        now = time.monotonic()
+        if not self.message_id or (not final and now - self._updated < interval):
+            return
+        self._updated = now
+        text = self._text(sent + failed + blocked, sent, failed, blocked, final)
+        self.outbox.submit("edit_message_text", self.admin_id, message_id=self.message_id, text=text)
+
+    def _text(self, done, sent, failed, blocked, final=None):
+        total = max(self.total, done)
+        percent = 100 * done / total if total else 100
+        lines = [
+            f"Broadcast #{self.broadcast_id} {final or 'in progress'}",
+            f"{done}/{total} ({percent:.1f}%)",
+            f"Sent: {sent}  Blocked: {blocked}  Failed: {failed}",
+        ]
+        if not final:
+            # Rate since this run started, so a resumed broadcast is not skewed by old progress
+            elapsed = time.monotonic() - self._started
+            rate = (done - self._done_before) / elapsed if elapsed > 0 else 0
+            eta = (total - done) / rate if rate else None
+            lines.append(f"Rate: {rate:.1f}/s  ETA: {_format_duration(eta) if eta is not None else 'estimating...'}")
+        return "\n".join(lines)
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m" if hours else f"{minutes}m {seconds:02d}s"
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+FOOTER = "*When you have enough points, you can redeem any item above ☝️ at anytime.\n I'm here to serve you 24x7 😎*"
+
+
+class RewardsCatalog:
+    """In-memory copy of the Rewards table, pre-rendered into message pages.
+
+    Stock is counted from the RewardCredentials pool. The tables are re-read
+    only when their fingerprint (reward count, latest updated_at, newest
+    credential and latest redemption) changes, checked at most once per
+    ``refresh_interval``.
+    Local redemptions update availability in place and re-render only the
+    affected page.
+    """
+
+    def __init__(self, db, page_size=10, refresh_interval=30):
+        self.db = db
+        self.page_size = page_size
+        self.refresh_interval = refresh_interval
+        self.reloads = 0
+        self._items = {}
+        self._item_pages = {}
+        self._page_items = []
+        self._pages = []
+        self._fingerprint = None
+        self._checked_at = float("-inf")
+        self._lock = asyncio.Lock()
+
+    async def pages(self):
+        await self._refresh_if_stale()
+        return self._pages
+
+    def invalidate(self):
+        self._fingerprint = None
+        self._checked_at = float("-inf")
+
+    def record_redemption(self, item_id):
+        item = self._items.get(item_id)
+        if item:
+            item["redeemed_count"] = min(item["redeemed_count"] + 1, item["max_count"])
+            self._render_page(self._item_pages[item_id])
+
+    def mark_sold_out(self, item_id):
+        item = self._items.get(item_id)
+        if item and item["redeemed_count"] < item["max_count"]:
+            item["redeemed_count"] = item["max_count"]
+            self._render_page(self._item_pages[item_id])
+            # A credential skipped because another redeemer had it locked may be
+            # released again, which changes no fingerprint; reload on the next check
+            self._fingerprint = None
+
+    async def _refresh_if_stale(self):
+        if time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+        async with self._lock:
+            if time.monotonic() - self._checked_at < self.refresh_interval:
+                return
+            fingerprint = await self.db.fetchone(
+                "SELECT (SELECT COUNT(*) FROM Rewards), (SELECT MAX(updated_at) FROM Rewards), "
+                "(SELECT MAX(id) FROM RewardCredentials), (SELECT MAX(redeemed_at) FROM RewardCredentials)"
+            )
+            if fingerprint != self._fingerprint:
+                await self._load()
+                self._fingerprint = fingerprint
+            self._checked_at = time.monotonic()
+
+    async def _load(self):
+        rows = await self.db.fetchall(
+            "SELECT r.item_id, r.item_description, r.points_required, COUNT(c.redeemed_by), COUNT(c.id) "
+            "FROM Rewards r LEFT JOIN RewardCredentials c ON c.item_id = r.item_id "
+            "GROUP BY r.item_id, r.item_description, r.points_required ORDER BY r.item_id"
+        )
+        self._items = {
+            item_id: {
+                "item_description": item_description,
+                "points_required": points_required,
+                "redeemed_count": redeemed_count,
+                "max_count": max_count,
+            }
+            for item_id, item_description, points_required, redeemed_count, max_count in rows
+        }
+        item_ids = list(self._items)
+        page_items = [item_ids[i:i + self.page_size] for i in range(0, len(item_ids), self.page_size)]
+        self._item_pages = {item_id: page for page, ids in enumerate(page_items) for item_id in ids}
+        self._page_items = page_items
+        self._pages = [None] * len(page_items)
+        for page in range(len(page_items)):
+            self._render_page(page)
+        self.reloads += 1
+        logger.info("Loaded %s rewards into %s catalog pages.", len(rows), len(self._pages))
+
+    def _render_page(self, page):
+        blocks = []
+        for item_id in self._page_items[page]:
+            item = self._items[item_id]
+            blocks.append(
+                f"*Item ID:* {item_id}\n"
+                f"*Name: {item['item_description']}*\n"
+                f"*Slots: {item['max_count'] - item['redeemed_count']}* out of {item['max_count']} available\n"
+                f"*Points Required:* {item['points_required']}"
+            )
+        header = f"*Rewards (page {page + 1} of {len(self._page_items)})*\n\n" if len(self._page_items) > 1 else ""
+        self._pages[page] = header + "\n\n".join(blocks) + "\n\n" + FOOTER
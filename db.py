@@ -0,0 +1,206 @@
+import asyncio
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mysql.connector import errors, pooling
+
+logger = logging.getLogger(__name__)
+
+# mysql.connector refuses pools larger than this
+MAX_POOL_SIZE = pooling.CNX_POOL_MAXSIZE
+
+
+class Database:
+    """Shared MySQL connection pool whose blocking calls run in a bounded thread pool.
+
+    The executor has exactly as many threads as the pool has connections, so a
+    checkout never has to wait on (or fail against) an exhausted pool.
+    """
+
+    def __init__(self, config, pool_size=10, pool_name="invitepal", retries=1, observer=None):
+        self.config = dict(config)
+        # Optional object with observe_query(query, seconds, failed) and observe_checkout(seconds)
+        self.observer = observer
+        self.pool_size = max(1, min(int(pool_size), MAX_POOL_SIZE))
+        self.pool_name = pool_name
+        self.retries = retries
+        self._pool = None
+        self._executor = None
+        self._health_task = None
+
+    def open(self):
+        if self._pool is not None:
+            return
+        # Sessions carry no state between calls, so skip the per-checkout
+        # COM_RESET_CONNECTION round trip. Single statements autocommit and
+        # run() opens explicit transactions.
+        self._pool = pooling.MySQLConnectionPool(
+            pool_name=self.pool_name,
+            pool_size=self.pool_size,
+            pool_reset_session=False,
+            autocommit=True,
+            **self.config,
+        )
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="db")
+        logger.info("Database pool '%s' opened with %s connections.", self.pool_name, self.pool_size)
+
+    async def close(self):
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        executor, pool = self._executor, self._pool
+        self._executor = self._pool = None
+        if executor:
+            # Waiting for in-flight queries blocks, so it happens off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, _shut_down, executor, pool)
+
+    def _run_sync(self, func, args, transaction, retry):
+        attempt = 0
+        while True:
+            # Nothing has reached the server until func runs, so failures up to
+            # that point can always be retried. A failure inside func may come
+            # after the server already committed (a procedure's own COMMIT, or
+            # autocommit), so only callers that declared func safe to repeat
+            # get a retry then.
+            sent = False
+            conn = None
+            try:
+                # The pool pings each connection on checkout and reconnects it if
+                # the server has gone away.
+                started = time.perf_counter()
+                conn = self._pool.get_connection()
+                if self.observer:
+                    self.observer.observe_checkout(time.perf_counter() - started)
+                if transaction:
+                    conn.start_transaction()
+                cursor = conn.cursor()
+                if self.observer:
+                    cursor = _TimedCursor(cursor, self.observer)
+                sent = True
+                try:
+                    result = func(cursor, *args)
+                finally:
+                    cursor.close()
+                if transaction:
+                    conn.commit()
+                return result
+            except (errors.OperationalError, errors.InterfaceError) as e:
+                if conn is not None:
+                    _rollback_quietly(conn)
+                if attempt >= self.retries or (sent and not retry):
+                    raise
+                attempt += 1
+                logger.warning("Database connection lost (%s); retrying (%s/%s).", e, attempt, self.retries)
+            except Exception:
+                if conn is not None:
+                    _rollback_quietly(conn)
+                raise
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception as e:
+                        logger.warning("Could not return connection to the pool: %s", e)
+
+    async def run(self, func, *args, transaction=True, retry=False):
+        """Run ``func(cursor, *args)`` on a pooled connection in a worker thread.
+
+        With ``transaction`` set, everything ``func`` does is committed together
+        or rolled back on error. Set ``retry`` only when ``func`` is safe to
+        run twice (plain reads): it is then repeated on a fresh connection if
+        the connection drops mid-call.
+        """
+        if self._pool is None:
+            # Opening connects and fills the pool synchronously, which must not
+            # happen on the event loop; callers open it up front (in an executor)
+            raise RuntimeError(f"Database pool '{self.pool_name}' is not open")
+        loop = asyncio.get_running_loop()
+        # Carry the caller's context into the worker thread so observers can attribute timings
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, self._run_sync, func, args, transaction, retry)
+
+    async def fetchone(self, query, params=()):
+        return await self.run(_fetchone, query, params, transaction=False, retry=True)
+
+    async def fetchall(self, query, params=()):
+        return await self.run(_fetchall, query, params, transaction=False, retry=True)
+
+    async def execute(self, query, params=()):
+        return await self.run(_execute, query, params, transaction=False)
+
+    async def ping(self):
+        try:
+            await self.fetchone("SELECT 1")
+            return True
+        except Exception as e:
+            logger.exception("Database health check failed: %s", e)
+            return False
+
+    def start_health_checks(self, interval):
+        if interval and interval > 0 and self._health_task is None:
+            self._health_task = asyncio.get_running_loop().create_task(self._health_loop(interval))
+
+    async def _health_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.ping()
+
+
+class _TimedCursor:
+    def __init__(self, cursor, observer):
+        self._cursor = cursor
+        self._observer = observer
+
+    def _timed(self, label, call, *args):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = call(*args)
+            failed = False
+            return result
+        finally:
+            self._observer.observe_query(label, time.perf_counter() - started, failed)
+
+    def execute(self, query, params=()):
+        return self._timed(query, self._cursor.execute, query, params)
+
+    def executemany(self, query, seq_params):
+        return self._timed(query, self._cursor.executemany, query, seq_params)
+
+    def callproc(self, procname, args=()):
+        return self._timed(f"CALL {procname}", self._cursor.callproc, procname, args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _shut_down(executor, pool):
+    executor.shutdown(wait=True)
+    if pool is not None:
+        # mysql.connector has no public way to close a pool; this closes the idle
+        # connections, which after the shutdown above is all of them
+        pool._remove_connections()
+
+
+def _rollback_quietly(conn):
+    try:
+        conn.rollback()
+    except Exception:
+        pass
+
+
+def _fetchone(cursor, query, params):
+    cursor.execute(query, params)
+    return cursor.fetchone()
+
+
+def _fetchall(cursor, query, params):
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+
+def _execute(cursor, query, params):
+    cursor.execute(query, params)
+    return cursor.rowcount
@@ -0,0 +1,129 @@
+"""Bulk-load reward credentials into the RewardCredentials pool.
+
+Reads CSV rows of ``item_id,secret_1[,secret_2]`` (or ``secret_1[,secret_2]``
+with --item) and inserts them in batched multi-row INSERTs, one transaction
+per batch. The file is streamed, so its size does not matter. Credentials
+already in the pool are skipped, which makes re-running an import safe.
+Database settings come from the same environment variables (or .env file)
+as the bot.
+
+    python import_credentials.py stock.csv
+    python import_credentials.py --item 401 --header accounts.csv
+"""
+import argparse
+import asyncio
+import csv
+import itertools
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+from mysql.connector.constants import ClientFlag
+
+from db import Database
+
+# A no-op update skips duplicates without INSERT IGNORE, which would also turn
+# data errors such as over-long secrets into warnings and truncate them
+INSERT_QUERY = (
+    "INSERT INTO RewardCredentials (item_id, secret_1, secret_2) VALUES (%s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE id = id"
+)
+
+# Length of the RewardCredentials secret columns, VARCHAR(255)
+MAX_SECRET_LENGTH = 255
+
+
+def read_rows(file, item_id=None, header=False):
+    """Yield (item_id, secret_1, secret_2) for every non-empty CSV row."""
+    reader = csv.reader(file)
+    if header:
+        next(reader, None)
+    for row in reader:
+        fields = [field.strip() for field in row]
+        if not any(fields):
+            continue
+        if item_id is None:
+            if not fields[0].isdigit():
+                raise ValueError(f"line {reader.line_num}: item_id must be a number, got {fields[0]!r}")
+            row_item_id, fields = int(fields[0]), fields[1:]
+        else:
+            row_item_id = item_id
+        if not fields or not fields[0] or len(fields) > 2:
+            raise ValueError(f"line {reader.line_num}: expected secret_1[,secret_2]")
+        if any(len(field) > MAX_SECRET_LENGTH for field in fields):
+            raise ValueError(f"line {reader.line_num}: secrets may be at most {MAX_SECRET_LENGTH} characters")
+        yield row_item_id, fields[0], fields[1] if len(fields) > 1 else ""
+
+
+def _insert_batch(cursor, batch):
+    # mysql.connector rewrites executemany on an INSERT into a single multi-row statement.
+    # Without FOUND_ROWS (see db_config) skipped duplicates count 0 affected rows
+    cursor.executemany(INSERT_QUERY, batch)
+    return cursor.rowcount
+
+
+def db_config():
+    load_dotenv()
+    return {
+        'host': os.getenv("DB_HOST"),
+        'user': os.getenv("DB_USER"),
+        'port': os.getenv("DB_PORT"),
+        'password': os.getenv("DB_PASSWORD"),
+        'database': os.getenv("DB_NAME"),
+        'client_flags': [-ClientFlag.FOUND_ROWS],
+    }
+
+
+async def import_credentials(db, rows, batch_size=5000):
+    """Insert credentials from ``rows`` and return (inserted, duplicates, unknown_items)."""
+    known_items = {item_id for (item_id,) in await db.fetchall("SELECT item_id FROM Rewards")}
+    inserted = duplicates = 0
+    unknown_items = set()
+    while True:
+        chunk = list(itertools.islice(rows, batch_size))
+        if not chunk:
+            break
+        batch = []
+        for item_id, secret_1, secret_2 in chunk:
+            if item_id in known_items:
+                batch.append((item_id, secret_1, secret_2))
+            else:
+                unknown_items.add(item_id)
+        if not batch:
+            continue
+        count = await db.run(_insert_batch, batch)
+        inserted += count
+        duplicates += len(batch) - count
+    return inserted, duplicates, unknown_items
+
+
+async def main(args):
+    db = Database(db_config(), pool_size=1, pool_name="import_credentials")
+    db.open()
+    started = time.perf_counter()
+    try:
+        with open(args.file, newline="", encoding="utf-8") as file:
+            rows = read_rows(file, item_id=args.item, header=args.header)
+            inserted, duplicates, unknown_items = await import_credentials(db, rows, batch_size=args.batch_size)
+    except ValueError as e:
+        print(f"Import stopped at {e}; earlier batches were kept.", file=sys.stderr)
+        return 1
+    finally:
+        await db.close()
+    elapsed = time.perf_counter() - started
+    print(f"inserted:    {inserted} credentials in {elapsed:.1f}s ({inserted / elapsed if elapsed else 0:.0f}/s)")
+    print(f"duplicates:  {duplicates} already in the pool")
+    if unknown_items:
+        print(f"skipped rows for unknown items: {', '.join(map(str, sorted(unknown_items)))}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="CSV file to import")
+    parser.add_argument("--item", type=int, help="item id for every row; the CSV then has no item_id column")
+    parser.add_argument("--header", action="store_true", help="skip the first line")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows per INSERT and transaction")
+    sys.exit(asyncio.run(main(parser.parse_args())))
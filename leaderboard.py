@@ -0,0 +1,84 @@
+import asyncio
+import bisect
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Leaderboard:
+    """Periodically refreshed snapshot of the top referrers.
+
+    Rankings come from the maintained ``Users.successful_referral_count``
+    column. Each refresh reads the top ``size`` rows and a histogram of
+    counts, so any user's rank is a binary search instead of a GROUP BY
+    per request.
+    """
+
+    def __init__(self, db, size=10, refresh_interval=300):
+        self.db = db
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self.refreshes = 0
+        self.refreshed_at = None
+        self.top = []
+        # Ascending distinct counts and, for each, how many users have at least that count
+        self._counts = []
+        self._at_least = []
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    async def snapshot(self):
+        if self.refreshed_at is None:
+            await self.refresh()
+        return self.top
+
+    def rank(self, count):
+        """1-based rank of a user with ``count`` successful referrals, or None if they have none."""
+        if count <= 0:
+            return None
+        # Ties share a rank; the count itself may be newer than the snapshot
+        index = bisect.bisect_right(self._counts, count)
+        return (self._at_least[index] if index < len(self._counts) else 0) + 1
+
+    def start(self):
+        if self.refresh_interval > 0 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def refresh(self):
+        async with self._lock:
+            top = await self.db.fetchall(
+                "SELECT telegram_id, username, first_name, successful_referral_count FROM Users "
+                "WHERE successful_referral_count > 0 ORDER BY successful_referral_count DESC, telegram_id LIMIT %s",
+                (self.size,),
+            )
+            # Served from idx_users_leaderboard without touching the rows
+            histogram = await self.db.fetchall(
+                "SELECT successful_referral_count, COUNT(*) FROM Users WHERE successful_referral_count > 0 "
+                "GROUP BY successful_referral_count ORDER BY successful_referral_count DESC"
+            )
+            counts, at_least, ranked = [], [], 0
+            for count, users in histogram:
+                ranked += users
+                counts.append(count)
+                at_least.append(ranked)
+            counts.reverse()
+            at_least.reverse()
+            self.top, self._counts, self._at_least = top, counts, at_least
+            self.refreshed_at = time.time()
+            self.refreshes += 1
+            logger.info("Leaderboard refreshed: %s ranked users, %s shown.", ranked, len(top))
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.exception("Leaderboard refresh failed: %s", e)
+            await asyncio.sleep(self.refresh_interval)
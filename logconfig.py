@@ -0,0 +1,163 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_state = {"handler": None}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, message, extra fields and the traceback if any."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Sampling and per-message-type rate limits for records below ERROR.
+
+    The message type is the unformatted template (``record.msg``), so
+    "Sent balance to user %s" is one type however many users it is logged
+    for. ``sample_rates`` maps template prefixes to the share of records
+    kept. Each type may then pass ``rate`` records per second with bursts
+    up to ``burst``; how many were dropped since the last one that passed is
+    reported on it as ``suppressed``. Errors always pass; warnings do not, as
+    some are logged per user and would flood the log during a rush.
+    """
+
+    def __init__(self, rate=20, burst=100, sample_rates=None, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_rates = dict(sample_rates or {})
+        self._clock = clock
+        self._types = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        template = str(record.msg)
+        sample_rate = self._sample_rate(template)
+        if sample_rate < 1:
+            if random.random() >= sample_rate:
+                return False
+            record.sampled = sample_rate
+        if not self.rate:
+            return True
+        now = self._clock()
+        with self._lock:
+            state = self._types.get(template)
+            if state is None:
+                # [tokens, last refill, dropped since the last record that passed]
+                state = self._types[template] = [self.burst, now, 0]
+            state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            state[1] = now
+            if state[0] < 1:
+                state[2] += 1
+                return False
+            state[0] -= 1
+            if state[2]:
+                record.suppressed, state[2] = state[2], 0
+        return True
+
+    def _sample_rate(self, template):
+        for prefix, rate in self.sample_rates.items():
+            if template.startswith(prefix):
+                return rate
+        return 1.0
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records unformatted and never blocks the caller.
+
+    The stock handler formats every record on the calling thread; here
+    formatting is left to the listener thread. Errors logged inside an
+    ``except`` block get the active exception attached, so they always
+    carry a traceback. A full queue drops the record and counts it, except
+    for errors, which are then written on the calling thread.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.listener = None
+        # Set by configure_logging; the handler the listener writes to
+        self.output = None
+        self._pid = os.getpid()
+
+    def prepare(self, record):
+        if record.levelno >= logging.ERROR and not record.exc_info:
+            exc_info = sys.exc_info()
+            if exc_info[0] is not None:
+                record.exc_info = exc_info
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.ERROR and self.output:
+                # Slower than queueing, but errors are rare and must not be lost
+                self.output.handle(record)
+            else:
+                self.dropped += 1
+
+    def close(self):
+        # Called by logging.shutdown(); writes out whatever is still queued.
+        # A forked child only inherits the listener object, not its thread
+        if self.listener and self._pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+
+def configure_logging(level=logging.INFO, queue_size=10000, rate=20, burst=100, sample_rates=None):
+    """Route all logging through a bounded queue drained by a background thread.
+
+    Safe to call more than once: after a fork (webhook workers) the child
+    gets its own queue and listener, since threads do not survive fork.
+    logging.shutdown(), which runs at interpreter exit, drains the queue.
+    """
+    handler = _state["handler"]
+    if handler and handler._pid == os.getpid():
+        return handler
+    log_queue = queue.Queue(maxsize=queue_size)
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(rate=rate, burst=burst, sample_rates=sample_rates))
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter())
+    handler.output = output
+    handler.listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    handler.listener.start()
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    _state["handler"] = handler
+    return handler
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+
+from telegram.error import BadRequest
+
+from outbox import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+def _write_memberships(cursor, states):
+    """Write ``states`` and return the users whose stored state went from not joined to joined."""
+    # Two set-based UPDATEs per flush instead of one round trip per user
+    newly_joined = []
+    for joined in (True, False):
+        user_ids = [user_id for user_id, state in states.items() if state is joined]
+        for i in range(0, len(user_ids), 1000):
+            chunk = user_ids[i:i + 1000]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            if joined:
+                # Locked until the UPDATE commits, so concurrent flushes see each change once
+                cursor.execute(f"SELECT telegram_id FROM Users WHERE telegram_id IN ({placeholders}) AND NOT is_joined FOR UPDATE", chunk)
+                newly_joined.extend(user_id for (user_id,) in cursor.fetchall())
+            cursor.execute(
+                f"UPDATE Users SET is_joined = %s, membership_checked_at = CURRENT_TIMESTAMP "
+                f"WHERE telegram_id IN ({placeholders})",
+                [joined, *chunk],
+            )
+    return newly_joined
+
+
+class MembershipTracker:
+    """Keeps Users.is_joined in step with the target channel.
+
+    Joins and leaves arrive as chat_member updates and are written in
+    batches. A background job re-checks users whose state is older than
+    ``stale_after`` seconds, with bounded concurrency and a call-rate cap.
+    Because the table is kept current, a recently confirmed row can answer
+    membership checks without calling get_chat_member. Users whose stored
+    state goes from not joined to joined are handed to ``on_join``.
+    """
+
+    def __init__(self, db, cache, channel, flush_interval=2, event_ttl=86400, trust_window=86400,
+                 stale_after=86400, reconcile_interval=60, reconcile_batch=500, reconcile_concurrency=5,
+                 reconcile_rate=10):
+        self.db = db
+        self.cache = cache
+        self.channel = channel
+        self.flush_interval = flush_interval
+        self.event_ttl = event_ttl
+        self.trust_window = trust_window
+        self.stale_after = stale_after
+        self.reconcile_interval = reconcile_interval
+        self.reconcile_batch = reconcile_batch
+        self.reconcile_concurrency = reconcile_concurrency
+        self.reconcile_rate = reconcile_rate
+        self.reconciled = 0
+        self._pending = {}
+        self._joined = set()
+        self._on_join = None
+        self._tasks = []
+
+    def record(self, user_id, joined, from_event=False):
+        # Pushed events stay valid until the next event, so they can be cached longer
+        self.cache.set(user_id, joined, ttl=self.event_ttl if from_event else None)
+        self._pending[user_id] = joined
+
+    async def lookup(self, user_id):
+        """Membership from a recently confirmed Users row, or None if it has to be asked for."""
+        row = await self.db.fetchone(
+            "SELECT is_joined FROM Users WHERE telegram_id = %s AND membership_checked_at > NOW() - INTERVAL %s SECOND",
+            (user_id, int(self.trust_window)),
+        )
+        if row is None:
+            return None
+        joined = bool(row[0])
+        self.cache.set(user_id, joined)
+        return joined
+
+    async def flush(self):
+        if self._pending:
+            states, self._pending = self._pending, {}
+            try:
+                self._joined.update(await self.db.run(_write_memberships, states))
+            except Exception as e:
+                logger.exception("Could not write %s membership changes: %s", len(states), e)
+                # Keep anything newer that arrived while the write was failing
+                self._pending = {**states, **self._pending}
+        if self._joined and self._on_join:
+            user_ids, self._joined = self._joined, set()
+            try:
+                await self._on_join(user_ids)
+            except Exception as e:
+                logger.exception("Could not handle %s new channel members: %s", len(user_ids), e)
+                # The change is already stored, so this is the only chance to act on it
+                self._joined |= user_ids
+
+    def start(self, bot, reconcile=True, on_join=None):
+        """``on_join`` is awaited with the set of users who just joined; it must be safe to repeat."""
+        self._on_join = on_join
+        loop = asyncio.get_running_loop()
+        self._tasks.append(loop.create_task(self._flush_loop()))
+        if reconcile and self.reconcile_interval > 0:
+            self._tasks.append(loop.create_task(self._reconcile_loop(bot)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _reconcile_loop(self, bot):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                await self.reconcile(bot)
+            except Exception as e:
+                logger.exception("Membership reconciliation failed: %s", e)
+
+    async def reconcile(self, bot):
+        rows = await self.db.fetchall(
+            "SELECT telegram_id FROM Users WHERE membership_checked_at IS NULL "
+            "OR membership_checked_at < NOW() - INTERVAL %s SECOND ORDER BY membership_checked_at LIMIT %s",
+            (int(self.stale_after), self.reconcile_batch),
+        )
+        # Users confirmed since the row was last written only need the timestamp refreshed
+        user_ids = []
+        for (user_id,) in rows:
+            if user_id in self.cache:
+                self._pending.setdefault(user_id, self.cache.get(user_id))
+            else:
+                user_ids.append(user_id)
+        semaphore = asyncio.Semaphore(self.reconcile_concurrency)
+        bucket = TokenBucket(self.reconcile_rate)
+
+        async def check(user_id):
+            async with semaphore:
+                while (wait := bucket.delay()) > 0:
+                    await asyncio.sleep(wait)
+                bucket.consume()
+                try:
+                    member = await bot.get_chat_member(self.channel, user_id)
+                    self.record(user_id, member.status in MEMBER_STATUSES)
+                except BadRequest:
+                    # Unknown or deleted accounts are not members
+                    self.record(user_id, False)
+                except Exception as e:
+                    logger.warning("Could not reconcile membership for user %s: %s", user_id, e)
+
+        await asyncio.gather(*(check(user_id) for user_id in user_ids))
+        await self.flush()
+        self.reconciled += len(user_ids)
+        if rows:
+            logger.info("Reconciled membership for %s users (%s checked with Telegram).", len(rows), len(user_ids))
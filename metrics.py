@@ -0,0 +1,229 @@
+import bisect
+import contextvars
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, summed) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', '+Inf')])} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {total}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {summed}")
+        return lines
+
+
+class GaugeCollector:
+    """Gauges read from a callback at scrape time; ``collect`` yields (labels, value) pairs."""
+
+    def __init__(self, name, documentation, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            for labels, value in self.collect():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        except Exception as e:
+            logger.exception("Could not collect %s: %s", self.name, e)
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(GaugeCollector(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram("invitepal_handler_seconds", "Handler latency.", ["handler"])
+handler_errors = registry.counter("invitepal_handler_errors_total", "Exceptions escaping a handler.", ["handler"])
+db_query_seconds = registry.histogram("invitepal_db_query_seconds", "Database statement latency.", ["statement"])
+db_query_errors = registry.counter("invitepal_db_query_errors_total", "Failed database statements.", ["statement"])
+db_checkout_seconds = registry.histogram("invitepal_db_checkout_seconds", "Time to check a connection out of the pool.")
+telegram_seconds = registry.histogram("invitepal_telegram_request_seconds", "Bot API call latency.", ["method"])
+telegram_errors = registry.counter("invitepal_telegram_errors_total", "Bot API calls that did not return 200.", ["method", "code"])
+telegram_rate_limited = registry.counter("invitepal_telegram_rate_limited_total", "Bot API calls answered with 429.", ["method"])
+
+# Set by the handler wrapper for sampled updates; DB and API timings append spans to it
+_trace = contextvars.ContextVar("invitepal_trace", default=None)
+
+_IN_LIST = re.compile(r"\((?:\s*%s\s*,)+\s*%s\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def statement_label(query):
+    """Short, bounded label for a SQL statement."""
+    query = _IN_LIST.sub("(...)", _SPACES.sub(" ", query.strip()))
+    return query if len(query) <= 80 else query[:77] + "..."
+
+
+def _span(kind, name, seconds):
+    trace = _trace.get()
+    if trace is not None:
+        trace.append((kind, name, seconds))
+
+
+class DatabaseObserver:
+    """Hooks for db.Database; called from its worker threads."""
+
+    def observe_query(self, query, seconds, failed):
+        label = statement_label(query)
+        db_query_seconds.observe(seconds, label)
+        if failed:
+            db_query_errors.inc(label)
+        _span("db", label, seconds)
+
+    def observe_checkout(self, seconds):
+        db_checkout_seconds.observe(seconds)
+        _span("db", "checkout", seconds)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and error codes per Bot API method."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            telegram_errors.inc(api_method, "network")
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            telegram_seconds.observe(seconds, api_method)
+            _span("telegram", api_method, seconds)
+        if code == 429:
+            telegram_rate_limited.inc(api_method)
+        if code != 200:
+            telegram_errors.inc(api_method, str(code))
+        return code, payload
+
+
+def instrument_handler(name, callback, sample_rate=0.0):
+    async def wrapper(update, context, *args, **kwargs):
+        trace = [] if sample_rate and random.random() < sample_rate else None
+        token = _trace.set(trace)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context, *args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            handler_seconds.observe(seconds, name)
+            _trace.reset(token)
+            if trace is not None:
+                spans = ", ".join(f"{kind}:{span} {span_seconds * 1000:.1f}ms" for kind, span, span_seconds in trace)
+                update_id = getattr(update, "update_id", None)
+                logger.info("Trace update=%s handler=%s total=%.1fms [%s]", update_id, name, seconds * 1000, spans)
+    return wrapper
+
+
+def start_http_server(port, host="127.0.0.1"):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Metrics served on http://%s:%s/metrics", host, port)
+    return server
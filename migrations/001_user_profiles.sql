@@ -0,0 +1,6 @@
+-- Store display names so /referrals can be served from the database
+USE Referral_Data;
+
+ALTER TABLE Users
+    ADD COLUMN first_name VARCHAR(255) DEFAULT NULL AFTER username,
+    ADD COLUMN last_name VARCHAR(255) DEFAULT NULL AFTER first_name;
@@ -0,0 +1,47 @@
+-- Atomic, single round trip redemption
+USE Referral_Data;
+
+DROP PROCEDURE IF EXISTS redeem_reward;
+
+DELIMITER //
+CREATE PROCEDURE redeem_reward(IN p_user_id BIGINT, IN p_item_id INT)
+BEGIN
+    DECLARE v_points_required INT;
+    DECLARE v_status VARCHAR(32) DEFAULT 'ok';
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    -- Claim a slot first; the row lock on the item serialises concurrent redeemers
+    UPDATE Rewards
+    SET redeemed_count = redeemed_count + 1
+    WHERE item_id = p_item_id AND redeemed_count < max_count;
+
+    IF ROW_COUNT() = 0 THEN
+        SET v_status = IF(EXISTS (SELECT 1 FROM Rewards WHERE item_id = p_item_id), 'sold_out', 'unknown_item');
+    ELSE
+        SELECT points_required INTO v_points_required FROM Rewards WHERE item_id = p_item_id;
+
+        -- Conditional deduction can never drive the balance negative
+        UPDATE Users
+        SET points_available = points_available - v_points_required
+        WHERE telegram_id = p_user_id AND points_available >= v_points_required;
+
+        IF ROW_COUNT() = 0 THEN
+            SET v_status = IF(EXISTS (SELECT 1 FROM Users WHERE telegram_id = p_user_id), 'insufficient_points', 'unknown_user');
+        END IF;
+    END IF;
+
+    IF v_status = 'ok' THEN
+        COMMIT;
+        SELECT v_status AS status, item_description, secret_1, secret_2 FROM Rewards WHERE item_id = p_item_id;
+    ELSE
+        ROLLBACK;
+        SELECT v_status AS status, NULL AS item_description, NULL AS secret_1, NULL AS secret_2;
+    END IF;
+END //
+DELIMITER ;
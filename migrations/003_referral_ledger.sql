@@ -0,0 +1,14 @@
+-- Append-only ledger of referral credits, applied to balances in batches
+USE Referral_Data;
+
+CREATE TABLE ReferralCredits (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    referrer_id BIGINT NOT NULL,
+    referee_id BIGINT NOT NULL,
+    points INT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    applied_at TIMESTAMP NULL DEFAULT NULL,
+    UNIQUE KEY uq_referral_credit_referee (referee_id),
+    KEY idx_referral_credit_pending (applied_at, id),
+    KEY idx_referral_credit_referrer (referrer_id, applied_at)
+);
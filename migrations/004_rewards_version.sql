@@ -0,0 +1,5 @@
+-- Lets the bot detect catalog changes with a cheap COUNT(*)/MAX(updated_at) check
+USE Referral_Data;
+
+ALTER TABLE Rewards
+    ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP;
@@ -0,0 +1,21 @@
+-- Resumable broadcasts and blocked-user tracking
+USE Referral_Data;
+
+ALTER TABLE Users
+    ADD COLUMN is_blocked BOOLEAN NOT NULL DEFAULT FALSE,
+    ADD INDEX idx_users_broadcast (is_joined, is_blocked, telegram_id);
+
+CREATE TABLE Broadcasts (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    admin_id BIGINT NOT NULL,
+    message TEXT NOT NULL,
+    status ENUM('running', 'done', 'cancelled') NOT NULL DEFAULT 'running',
+    last_telegram_id BIGINT NOT NULL DEFAULT 0,
+    total INT NOT NULL DEFAULT 0,
+    sent INT NOT NULL DEFAULT 0,
+    failed INT NOT NULL DEFAULT 0,
+    blocked INT NOT NULL DEFAULT 0,
+    progress_message_id BIGINT DEFAULT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_broadcasts_status (status)
+);
@@ -0,0 +1,6 @@
+-- When each user's channel membership was last confirmed
+USE Referral_Data;
+
+ALTER TABLE Users
+    ADD COLUMN membership_checked_at TIMESTAMP NULL DEFAULT NULL,
+    ADD INDEX idx_users_membership_checked (membership_checked_at);
@@ -0,0 +1,27 @@
+-- Maintained referral counters and the indexes behind /referrals and /leaderboard
+USE Referral_Data;
+
+ALTER TABLE Users
+    ADD COLUMN referral_count INT NOT NULL DEFAULT 0,
+    ADD COLUMN successful_referral_count INT NOT NULL DEFAULT 0,
+    ADD INDEX idx_users_referred_by (referred_by, telegram_id),
+    ADD INDEX idx_users_leaderboard (successful_referral_count, telegram_id);
+
+-- Backfill from existing rows. A referral is successful once the referee is marked
+-- points_credited, which also covers credits given before the ReferralCredits ledger
+-- existed. Referees whose ledger credit is still pending are left out; the bot adds
+-- them when it applies the credit.
+UPDATE Users u
+JOIN (SELECT referred_by, COUNT(*) AS total FROM Users WHERE referred_by IS NOT NULL GROUP BY referred_by) r
+    ON r.referred_by = u.telegram_id
+SET u.referral_count = r.total;
+
+UPDATE Users u
+JOIN (
+    SELECT referred_by, COUNT(*) AS total
+    FROM Users referee
+    WHERE points_credited AND referred_by IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM ReferralCredits c WHERE c.referee_id = referee.telegram_id AND c.applied_at IS NULL)
+    GROUP BY referred_by
+) s ON s.referred_by = u.telegram_id
+SET u.successful_referral_count = s.total;
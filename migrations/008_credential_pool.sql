@@ -0,0 +1,90 @@
+-- One credential per redemption, claimed from a pool instead of sharing Rewards.secret_1/secret_2.
+-- Stock (max_count/redeemed_count) is now counted from the pool, so those columns go away.
+USE Referral_Data;
+
+CREATE TABLE RewardCredentials (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    item_id INT NOT NULL,
+    secret_1 VARCHAR(255) NOT NULL,
+    secret_2 VARCHAR(255) NOT NULL DEFAULT '',
+    redeemed_by BIGINT DEFAULT NULL,
+    redeemed_at TIMESTAMP NULL DEFAULT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_reward_credential (item_id, secret_1, secret_2),
+    KEY idx_reward_credential_available (item_id, redeemed_by, id),
+    KEY idx_reward_credential_redeemed_at (redeemed_at),
+    FOREIGN KEY (item_id) REFERENCES Rewards(item_id) ON DELETE CASCADE
+);
+
+-- Carry over each item's shared credential once if it still had slots left. Restock with
+-- import_credentials.py to get back to one credential per slot.
+INSERT INTO RewardCredentials (item_id, secret_1, secret_2)
+SELECT item_id, secret_1, secret_2 FROM Rewards WHERE redeemed_count < max_count;
+
+ALTER TABLE Rewards
+    DROP COLUMN secret_1,
+    DROP COLUMN secret_2,
+    DROP COLUMN redeemed_count,
+    DROP COLUMN max_count;
+
+DROP PROCEDURE IF EXISTS redeem_reward;
+
+DELIMITER //
+CREATE PROCEDURE redeem_reward(IN p_user_id BIGINT, IN p_item_id INT)
+BEGIN
+    DECLARE v_points_required INT DEFAULT NULL;
+    DECLARE v_credential_id BIGINT DEFAULT NULL;
+    DECLARE v_status VARCHAR(32) DEFAULT 'ok';
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    SELECT points_required INTO v_points_required FROM Rewards WHERE item_id = p_item_id;
+
+    IF v_points_required IS NULL THEN
+        SET v_status = 'unknown_item';
+    ELSE
+        -- Deduct first: it locks only the caller's row, so users without enough
+        -- points never hold a credential. The condition keeps balances non-negative
+        UPDATE Users
+        SET points_available = points_available - v_points_required
+        WHERE telegram_id = p_user_id AND points_available >= v_points_required;
+
+        IF ROW_COUNT() = 0 THEN
+            SET v_status = IF(EXISTS (SELECT 1 FROM Users WHERE telegram_id = p_user_id), 'insufficient_points', 'unknown_user');
+        ELSE
+            -- Claim one unused credential; rows locked by concurrent redeemers are skipped
+            -- instead of waited on, so a flash sale does not queue on a single row
+            SELECT id INTO v_credential_id
+            FROM RewardCredentials
+            WHERE item_id = p_item_id AND redeemed_by IS NULL
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED;
+
+            IF v_credential_id IS NULL THEN
+                -- Rolled back below, which refunds the deduction
+                SET v_status = 'sold_out';
+            ELSE
+                UPDATE RewardCredentials
+                SET redeemed_by = p_user_id, redeemed_at = CURRENT_TIMESTAMP
+                WHERE id = v_credential_id;
+            END IF;
+        END IF;
+    END IF;
+
+    IF v_status = 'ok' THEN
+        COMMIT;
+        SELECT v_status AS status, r.item_description, c.secret_1, c.secret_2
+        FROM RewardCredentials c JOIN Rewards r ON r.item_id = c.item_id
+        WHERE c.id = v_credential_id;
+    ELSE
+        ROLLBACK;
+        SELECT v_status AS status, NULL AS item_description, NULL AS secret_1, NULL AS secret_2;
+    END IF;
+END //
+DELIMITER ;
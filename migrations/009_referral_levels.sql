@@ -0,0 +1,12 @@
+-- Multi-level referral credits and the timestamps the referral graph syncs on
+USE Referral_Data;
+
+ALTER TABLE Users
+    ADD COLUMN created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ADD INDEX idx_users_created (created_at);
+
+-- A referee now produces one credit per level instead of exactly one
+ALTER TABLE ReferralCredits
+    ADD COLUMN level TINYINT NOT NULL DEFAULT 1,
+    DROP INDEX uq_referral_credit_referee,
+    ADD UNIQUE KEY uq_referral_credit_referee (referee_id, level);
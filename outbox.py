@@ -0,0 +1,371 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import multiprocessing
+import time
+from collections import deque
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Lower value is sent first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+MAX_MESSAGE_LENGTH = 4096
+
+# send_message options that still allow a text to be folded into its neighbour
+MERGEABLE_KWARGS = {"text", "parse_mode", "reply_markup"}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        # Below one token the bucket could never pay for a call, however long it waited
+        self.capacity = max(1, capacity or rate)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, reserve=0):
+        """Seconds until one token is available with ``reserve`` more left over."""
+        self._refill()
+        needed = 1 + reserve
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def consume(self, tokens=1):
+        self._refill()
+        self.tokens -= tokens
+
+    def try_consume(self, tokens=1):
+        """Take ``tokens`` if they are all available; never goes into debt."""
+        self._refill()
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class SharedTokenBucket(TokenBucket):
+    """A TokenBucket whose state lives in shared memory.
+
+    Processes started from one parent draw on the same budget, so whichever
+    of them is busy can use what the others leave idle. Create the state
+    with ``shared_state()`` before starting the processes and hand it to
+    each; time.monotonic is system-wide, so their refills agree.
+    """
+
+    def __init__(self, rate, state, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = max(1, capacity or rate)
+        self._state = state
+        self._clock = clock
+
+    @staticmethod
+    def shared_state():
+        # [tokens, last refill]; NaN until first used, when the bucket starts full
+        return multiprocessing.Array("d", [math.nan, 0.0])
+
+    @property
+    def tokens(self):
+        with self._state.get_lock():
+            return self._refill()
+
+    def _refill(self):
+        # Callers hold the state lock
+        now = self._clock()
+        tokens, updated = self._state
+        tokens = self.capacity if math.isnan(tokens) else min(self.capacity, tokens + (now - updated) * self.rate)
+        self._state[0], self._state[1] = tokens, now
+        return tokens
+
+    def delay(self, reserve=0):
+        with self._state.get_lock():
+            tokens = self._refill()
+        needed = 1 + reserve
+        return 0.0 if tokens >= needed else (needed - tokens) / self.rate
+
+    def consume(self, tokens=1):
+        with self._state.get_lock():
+            self._state[0] = self._refill() - tokens
+
+    def try_consume(self, tokens=1):
+        with self._state.get_lock():
+            available = self._refill()
+            if available < tokens:
+                return False
+            self._state[0] = available - tokens
+            return True
+
+
+def is_unreachable(error):
+    """True for send errors that mean the chat cannot be messaged at all (blocked bot, deleted account)."""
+    return isinstance(error, Forbidden) or (isinstance(error, BadRequest) and "chat not found" in str(error).lower())
+
+
+class _Job:
+    __slots__ = ("method", "chat_id", "kwargs", "priority", "seq", "future", "enqueued_at", "attempts")
+
+    def __init__(self, method, chat_id, kwargs, priority, seq):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.future = asyncio.get_running_loop().create_future()
+        # Callers usually fire and forget; failures are logged here instead
+        self.future.add_done_callback(_consume_exception)
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+    def mergeable(self):
+        return self.method == "send_message" and self.kwargs.keys() <= MERGEABLE_KWARGS
+
+
+def _consume_exception(future):
+    if not future.cancelled():
+        future.exception()
+
+
+class Outbox:
+    """Central queue for outbound Bot API calls.
+
+    Calls are ordered per chat and picked across chats by priority, then age.
+    A global and a per-chat token bucket keep sends under Telegram's limits,
+    RetryAfter pauses sending for the requested time, and consecutive plain
+    texts queued for the same chat go out as one message. Low-priority sends
+    leave ``low_priority_reserve`` global tokens unspent, so bulk traffic
+    never drains the budget that interactive replies (possibly from other
+    processes sharing it) are waiting on.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3, merge=True, latency_window=1000,
+                 low_priority_reserve=0):
+        self.low_priority_reserve = low_priority_reserve
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.merge = merge
+        self._bot = None
+        self._global = TokenBucket(global_rate)
+        self._chat_buckets = TTLCache(maxsize=100000, ttl=max(60, chat_burst / chat_rate))
+        self._chats = {}
+        self._ready = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._paused_until = 0.0
+        self._task = None
+        self._report_task = None
+        self._inflight = set()
+        self._latencies = deque(maxlen=latency_window)
+        self.pending = 0
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+    def start(self, bot, report_interval=0):
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._dispatch())
+        if report_interval and report_interval > 0:
+            self._report_task = asyncio.get_running_loop().create_task(self._report(report_interval))
+
+    async def stop(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while (self.pending or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in (self._task, self._report_task):
+            if task:
+                task.cancel()
+        self._task = self._report_task = None
+
+    def set_global_rate(self, rate):
+        self._global = TokenBucket(rate)
+
+    def share_global_rate(self, state):
+        """Draw on a global budget shared with other processes; ``state`` comes from SharedTokenBucket.shared_state()."""
+        self._global = SharedTokenBucket(self._global.rate, state)
+
+    def submit(self, method, chat_id, priority=PRIORITY_NORMAL, **kwargs):
+        job = _Job(method, chat_id, kwargs, priority, next(self._seq))
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+            queue.append(job)
+            self.pending += 1
+            self._schedule(chat_id)
+        else:
+            # The chat is already scheduled or in flight; it is picked up in turn
+            queue.append(job)
+            self.pending += 1
+        return job.future
+
+    def send_message(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        return self.submit("send_message", chat_id, priority, text=text, **kwargs)
+
+    def send_sticker(self, chat_id, sticker, priority=PRIORITY_NORMAL, **kwargs):
+        return self.submit("send_sticker", chat_id, priority, sticker=sticker, **kwargs)
+
+    def _schedule(self, chat_id):
+        queue = self._chats.get(chat_id)
+        if not queue:
+            self._chats.pop(chat_id, None)
+            return
+        head = queue[0]
+        heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    def _take(self, chat_id):
+        queue = self._chats[chat_id]
+        jobs = [queue.popleft()]
+        if self.merge and jobs[0].mergeable():
+            length = len(jobs[0].kwargs["text"])
+            parse_mode = jobs[0].kwargs.get("parse_mode")
+            while queue and "reply_markup" not in jobs[-1].kwargs:
+                following = queue[0]
+                if not following.mergeable() or following.kwargs.get("parse_mode") != parse_mode:
+                    break
+                length += 2 + len(following.kwargs["text"])
+                if length > MAX_MESSAGE_LENGTH:
+                    break
+                jobs.append(queue.popleft())
+        self.pending -= len(jobs)
+        return jobs
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            reserve = 0
+            if self._ready[0][0] >= PRIORITY_LOW:
+                reserve = min(self.low_priority_reserve, self._global.capacity - 1)
+            wait = max(self._paused_until - time.monotonic(), self._global.delay(reserve))
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            bucket = self._chat_bucket(chat_id)
+            chat_wait = bucket.delay()
+            if chat_wait > 0:
+                loop.call_later(chat_wait, self._schedule, chat_id)
+                continue
+
+            jobs = self._take(chat_id)
+            self._global.consume()
+            bucket.consume()
+            task = loop.create_task(self._deliver(chat_id, jobs))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, chat_id, jobs):
+        head = jobs[0]
+        kwargs = dict(head.kwargs)
+        if len(jobs) > 1:
+            kwargs["text"] = "\n\n".join(job.kwargs["text"] for job in jobs)
+            if "reply_markup" in jobs[-1].kwargs:
+                kwargs["reply_markup"] = jobs[-1].kwargs["reply_markup"]
+        retry_in = None
+        try:
+            result = await getattr(self._bot, head.method)(chat_id=chat_id, **kwargs)
+        except RetryAfter as e:
+            self.rate_limited += 1
+            retry_in = e.retry_after
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_in)
+            logger.warning("Rate limited by Telegram; pausing sends for %ss.", retry_in)
+        except (BadRequest, Forbidden) as e:
+            # Rejected by Telegram; sending it again would fail the same way
+            self._fail(jobs, e)
+        except NetworkError as e:
+            # A timed-out request may still have been delivered, so only retry
+            # failures that happened before the request reached Telegram
+            head.attempts += 1
+            if isinstance(e, TimedOut) or head.attempts > self.max_retries:
+                self._fail(jobs, e)
+            else:
+                retry_in = min(2 ** head.attempts, 30)
+                logger.warning("Network error sending %s to %s: %s; retrying in %ss.", head.method, chat_id, e, retry_in)
+        except Exception as e:
+            self._fail(jobs, e)
+        else:
+            now = time.monotonic()
+            for job in jobs:
+                self._latencies.append(now - job.enqueued_at)
+                if not job.future.done():
+                    job.future.set_result(result)
+            self.sent += 1
+            self.merged += len(jobs) - 1
+
+        if retry_in is not None:
+            # Put the originals back at the front so the chat keeps its order
+            self.retried += 1
+            self._chats.setdefault(chat_id, deque()).extendleft(reversed(jobs))
+            self.pending += len(jobs)
+            asyncio.get_running_loop().call_later(retry_in, self._schedule, chat_id)
+        else:
+            self._schedule(chat_id)
+
+    def _fail(self, jobs, error):
+        self.failed += len(jobs)
+        if is_unreachable(error):
+            # Expected for any large audience; callers decide what it means
+            logger.info("Could not %s to chat %s: %s", jobs[0].method, jobs[0].chat_id, error)
+        else:
+            logger.error("Could not %s to chat %s: %s", jobs[0].method, jobs[0].chat_id, error, exc_info=error)
+        for job in jobs:
+            if not job.future.done():
+                job.future.set_exception(error)
+
+    def metrics(self):
+        latencies = sorted(self._latencies)
+        return {
+            "queue_depth": self.pending,
+            "active_chats": len(self._chats),
+            "in_flight": len(self._inflight),
+            "sent": self.sent,
+            "merged": self.merged,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "failed": self.failed,
+            "latency_p50": _percentile(latencies, 0.50),
+            "latency_p95": _percentile(latencies, 0.95),
+            "latency_p99": _percentile(latencies, 0.99),
+        }
+
+    async def _report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            m = self.metrics()
+            logger.info(
+                "Outbox: depth=%s sent=%s merged=%s retried=%s failed=%s latency p50=%.3fs p99=%.3fs",
+                m["queue_depth"], m["sent"], m["merged"], m["retried"], m["failed"], m["latency_p50"], m["latency_p99"],
+            )
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
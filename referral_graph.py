@@ -0,0 +1,220 @@
+import logging
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+NONE = -1
+
+
+class ReferralGraph:
+    """In-memory referral tree over flat arrays, keyed by telegram_id.
+
+    Every user is a dense node index. Parent, first child, next sibling,
+    child count and subtree size are parallel arrays, so a node costs a few
+    dozen bytes and walks touch no Python objects besides the id index.
+    Subtree sizes are kept up to date on every attach (O(depth)), which makes
+    subtree size O(1) and depth-N ancestors O(N).
+
+    Referrers can show up before their own row does; they get a detached
+    node that is attached when the row arrives.
+    """
+
+    def __init__(self, chain_threshold=5):
+        self.chain_threshold = chain_threshold
+        self._index = {}
+        self._ids = array("q")
+        self._parent = array("i")
+        self._first_child = array("i")
+        self._next_sibling = array("i")
+        self._children = array("i")
+        self._subtree = array("i")
+        self._joined = bytearray()
+        self._synced_at = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, telegram_id):
+        return telegram_id in self._index
+
+    def add(self, telegram_id, referred_by=None, joined=False):
+        """Insert or update a user; safe to call again for a user already in the graph."""
+        node = self._node(telegram_id)
+        self._joined[node] = bool(joined)
+        if referred_by and referred_by != telegram_id and self._parent[node] == NONE:
+            self._attach(node, self._node(referred_by))
+
+    def set_joined(self, telegram_id, joined):
+        node = self._index.get(telegram_id)
+        if node is not None:
+            self._joined[node] = bool(joined)
+
+    def subtree_size(self, telegram_id):
+        """Users referred directly or indirectly by ``telegram_id``."""
+        node = self._index.get(telegram_id)
+        return self._subtree[node] if node is not None else 0
+
+    def direct_referrals(self, telegram_id):
+        node = self._index.get(telegram_id)
+        return self._children[node] if node is not None else 0
+
+    def ancestors(self, telegram_id, depth):
+        """Up to ``depth`` referrers above ``telegram_id``, nearest first."""
+        result = []
+        node = self._index.get(telegram_id, NONE)
+        while len(result) < depth and node != NONE:
+            node = self._parent[node]
+            if node != NONE:
+                result.append(self._ids[node])
+        return result
+
+    def chain_length(self, telegram_id):
+        """Length of the run of single-referral accounts through ``telegram_id``.
+
+        Farming rings show up as chains where every account referred exactly
+        one other account, each collecting the next level's bonus.
+        """
+        node = self._index.get(telegram_id)
+        if node is None or self._children[node] != 1:
+            return 0
+        length = 1
+        up = self._parent[node]
+        while up != NONE and self._children[up] == 1:
+            length += 1
+            up = self._parent[up]
+        down = self._first_child[node]
+        while self._children[down] == 1:
+            length += 1
+            down = self._first_child[down]
+        return length
+
+    def throwaway_referrals(self, telegram_id):
+        """Direct referrals that never joined the channel and never referred anyone."""
+        node = self._index.get(telegram_id)
+        count = 0
+        child = self._first_child[node] if node is not None else NONE
+        while child != NONE:
+            if not self._joined[child] and self._children[child] == 0:
+                count += 1
+            child = self._next_sibling[child]
+        return count
+
+    def is_suspicious(self, telegram_id):
+        return self.chain_length(telegram_id) >= self.chain_threshold
+
+    def suspicious_clusters(self, min_throwaways=20, throwaway_ratio=0.8, limit=10):
+        """Largest chains and throwaway fan-outs in the whole graph.
+
+        A full scan, O(users); meant for occasional admin use.
+        Returns (telegram_id, kind, size) tuples, biggest first.
+        """
+        found = []
+        children, parent, first_child = self._children, self._parent, self._first_child
+        for node in range(len(self._ids)):
+            count = children[node]
+            if count == 1 and (parent[node] == NONE or children[parent[node]] != 1):
+                # Head of a single-referral chain
+                length, down = 1, first_child[node]
+                while children[down] == 1:
+                    length += 1
+                    down = first_child[down]
+                if length >= self.chain_threshold:
+                    found.append((self._ids[node], "chain", length))
+            elif count >= min_throwaways:
+                throwaways = self.throwaway_referrals(self._ids[node])
+                if throwaways >= min_throwaways and throwaways >= throwaway_ratio * count:
+                    found.append((self._ids[node], "throwaways", throwaways))
+        found.sort(key=lambda cluster: cluster[2], reverse=True)
+        return found[:limit]
+
+    async def load(self, db, batch_size=50000):
+        """Build the graph from Users, reading it in keyset pages.
+
+        Links are made without the per-attach walks; subtree sizes are then
+        counted in one pass over the whole tree.
+        """
+        started = time.perf_counter()
+        self._synced_at = (await db.fetchone("SELECT NOW()"))[0]
+        last_id = 0
+        while True:
+            rows = await db.fetchall(
+                "SELECT telegram_id, referred_by, is_joined FROM Users WHERE telegram_id > %s ORDER BY telegram_id LIMIT %s",
+                (last_id, batch_size),
+            )
+            for telegram_id, referred_by, joined in rows:
+                node = self._node(telegram_id)
+                self._joined[node] = bool(joined)
+                if referred_by and referred_by != telegram_id and self._parent[node] == NONE:
+                    self._link(node, self._node(referred_by))
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+        self._recount()
+        logger.info("Referral graph built with %s users in %.1fs.", len(self), time.perf_counter() - started)
+
+    async def sync(self, db, overlap=5):
+        """Pick up users added, and memberships changed, by other processes since the last sync."""
+        synced_at = (await db.fetchone("SELECT NOW()"))[0]
+        since = (self._synced_at or synced_at)
+        for column in ("created_at", "membership_checked_at"):
+            rows = await db.fetchall(
+                f"SELECT telegram_id, referred_by, is_joined FROM Users WHERE {column} >= %s - INTERVAL %s SECOND",
+                (since, overlap),
+            )
+            for telegram_id, referred_by, joined in rows:
+                self.add(telegram_id, referred_by, joined)
+        self._synced_at = synced_at
+
+    def _node(self, telegram_id):
+        node = self._index.get(telegram_id)
+        if node is None:
+            node = self._index[telegram_id] = len(self._ids)
+            self._ids.append(telegram_id)
+            self._parent.append(NONE)
+            self._first_child.append(NONE)
+            self._next_sibling.append(NONE)
+            self._children.append(0)
+            self._subtree.append(0)
+            self._joined.append(0)
+        return node
+
+    def _attach(self, node, parent):
+        # Refuse links that would close a loop, e.g. from inconsistent rows
+        ancestor = parent
+        while ancestor != NONE:
+            if ancestor == node:
+                logger.warning("Ignoring referral cycle through user %s.", self._ids[node])
+                return
+            ancestor = self._parent[ancestor]
+        self._link(node, parent)
+        added = self._subtree[node] + 1
+        while parent != NONE:
+            self._subtree[parent] += added
+            parent = self._parent[parent]
+
+    def _link(self, node, parent):
+        self._parent[node] = parent
+        self._next_sibling[node] = self._first_child[parent]
+        self._first_child[parent] = node
+        self._children[parent] += 1
+
+    def _recount(self):
+        # Breadth-first from the roots, then sizes are summed leaves-up
+        parent, first_child, next_sibling = self._parent, self._first_child, self._next_sibling
+        order = [node for node in range(len(self._ids)) if parent[node] == NONE]
+        i = 0
+        while i < len(order):
+            child = first_child[order[i]]
+            while child != NONE:
+                order.append(child)
+                child = next_sibling[child]
+            i += 1
+        if len(order) < len(self._ids):
+            # Only possible with a referral cycle in the table; those users are left uncounted
+            logger.warning("%s users in referral cycles were not counted.", len(self._ids) - len(order))
+        subtree = array("i", bytes(4 * len(self._ids)))
+        for node in reversed(order):
+            if parent[node] != NONE:
+                subtree[parent[node]] += subtree[node] + 1
+        self._subtree = subtree
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedScheduler:
+    """Runs work concurrently across keys but strictly in order within a key.
+
+    At most ``max_in_flight`` jobs run at once. ``submit`` blocks once
+    ``max_pending`` jobs are queued, which pushes back on whoever is feeding
+    updates in. A key's queue is dropped as soon as it drains, so memory
+    follows the number of active keys.
+    """
+
+    def __init__(self, max_in_flight=64, max_pending=10000):
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self._running = asyncio.Semaphore(max_in_flight)
+        self._pending_slots = asyncio.Semaphore(max_pending)
+        self._queues = {}
+        self._tasks = set()
+        self._report_task = None
+        self.pending = 0
+        self.in_flight = 0
+        self.completed = 0
+
+    async def submit(self, key, job):
+        """Queue ``job`` (a zero-argument coroutine function) behind earlier jobs for ``key``."""
+        await self._pending_slots.acquire()
+        self.pending += 1
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque([job])
+            task = asyncio.get_running_loop().create_task(self._drain(key, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            queue.append(job)
+
+    async def _drain(self, key, queue):
+        while queue:
+            # The head stays queued while it runs so new jobs line up behind it
+            job = queue[0]
+            async with self._running:
+                self.in_flight += 1
+                try:
+                    await job()
+                except Exception as e:
+                    logger.exception("Unhandled error in scheduled job for key %s: %s", key, e)
+                finally:
+                    self.in_flight -= 1
+            queue.popleft()
+            self.pending -= 1
+            self.completed += 1
+            self._pending_slots.release()
+        del self._queues[key]
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def depth(self, key):
+        queue = self._queues.get(key)
+        return len(queue) if queue else 0
+
+    def stats(self, top=5):
+        deepest = sorted(self._queues.items(), key=lambda item: len(item[1]), reverse=True)[:top]
+        return {
+            "pending": self.pending,
+            "in_flight": self.in_flight,
+            "active_keys": len(self._queues),
+            "completed": self.completed,
+            "deepest_keys": {key: len(queue) for key, queue in deepest},
+        }
+
+    def start_reporting(self, interval):
+        if interval and interval > 0 and self._report_task is None:
+            self._report_task = asyncio.get_running_loop().create_task(self._report(interval))
+
+    def stop_reporting(self):
+        if self._report_task:
+            self._report_task.cancel()
+            self._report_task = None
+
+    async def _report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            s = self.stats()
+            logger.info(
+                "Updates: pending=%s in_flight=%s active_users=%s completed=%s deepest=%s",
+                s["pending"], s["in_flight"], s["active_keys"], s["completed"], s["deepest_keys"],
+            )
@@ -0,0 +1,76 @@
+import time
+
+from cache import TTLCache
+from outbox import TokenBucket
+
+# Reasons returned by Throttle.admit
+LIMITED = "limited"
+BUSY = "busy"
+
+
+class Throttle:
+    """Per-user token buckets plus a global cap on admitted updates.
+
+    Every command costs a number of tokens (``costs``, else ``default_cost``);
+    each user's bucket refills at ``rate`` tokens per second up to ``burst``.
+    At most ``max_concurrent`` admitted updates may be queued or running at
+    once, and anything beyond that is rejected straight away instead of
+    waiting. Buckets live in an LRU cache and expire once they would have
+    refilled completely, so forgetting one loses nothing and memory stays
+    bounded by ``max_users``.
+    """
+
+    def __init__(self, rate=1, burst=5, costs=None, default_cost=1, max_concurrent=500, cooldown=10,
+                 max_users=100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.costs = dict(costs or {})
+        self.default_cost = default_cost
+        self.max_concurrent = max_concurrent
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.admitted = 0
+        self.limited = 0
+        self.busy = 0
+        self._clock = clock
+        self._buckets = TTLCache(maxsize=max_users, ttl=burst / rate, clock=clock)
+        # Users told to slow down recently; they are not told again until it expires
+        self._notified = TTLCache(maxsize=max_users, ttl=cooldown, clock=clock)
+
+    def admit(self, user_id, command):
+        """Returns None when the update may run (call ``release`` when it is done), else LIMITED or BUSY."""
+        if self.in_flight >= self.max_concurrent:
+            self.busy += 1
+            return BUSY
+        cost = self.costs.get(command, self.default_cost)
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, clock=self._clock)
+        allowed = bucket.try_consume(cost)
+        # Re-set on every call so an active user's bucket is kept until it has refilled
+        self._buckets.set(user_id, bucket)
+        if not allowed:
+            self.limited += 1
+            return LIMITED
+        self.in_flight += 1
+        self.admitted += 1
+        return None
+
+    def release(self):
+        self.in_flight -= 1
+
+    def should_notify(self, user_id):
+        """True at most once per ``cooldown`` for each user."""
+        if user_id in self._notified:
+            return False
+        self._notified.set(user_id, True)
+        return True
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "limited": self.limited,
+            "busy": self.busy,
+            "tracked_users": len(self._buckets),
+        }
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Bot, Update
+
+logger = logging.getLogger(__name__)
+
+# Update fields that carry the user who triggered the update
+USER_FIELDS = (
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+    "chat_join_request",
+)
+
+
+def shard_key(data):
+    """User id for an update, so every update from one user lands on the same worker."""
+    for field in USER_FIELDS:
+        payload = data.get(field)
+        if payload:
+            user = payload.get("from") or payload.get("user")
+            if user and "id" in user:
+                return user["id"]
+            chat = payload.get("chat")
+            if chat and "id" in chat:
+                return chat["id"]
+    return data.get("update_id", 0)
+
+
+def _make_handler(path, secret_token, queues):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                self.send_error(404)
+                return
+            if secret_token and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+                self.send_error(403)
+                return
+            try:
+                data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            except ValueError:
+                self.send_error(400)
+                return
+            queues[shard_key(data) % len(queues)].put(data)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return WebhookHandler
+
+
+def _worker_main(index, worker_count, build_application, updates):
+    # The front end owns shutdown; workers stop when they read the None sentinel.
+    # Service managers signal the whole process group, so both signals are ignored
+    # here or workers would die without draining
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        asyncio.run(_run_worker(index, worker_count, build_application, updates))
+    finally:
+        # Worker processes exit without running atexit hooks, so flush queued log records here
+        logging.shutdown()
+
+
+async def _run_worker(index, worker_count, build_application, updates):
+    application = build_application(updater=False, worker_count=worker_count, worker_index=index)
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info("Webhook worker %s started.", index)
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        logger.info("Webhook worker %s stopped.", index)
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+async def _set_webhook(token, url, secret_token, max_connections):
+    async with Bot(token) as bot:
+        await bot.set_webhook(
+            url=url,
+            secret_token=secret_token or None,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=max_connections,
+        )
+
+
+def run_webhook(build_application, token, url, listen="0.0.0.0", port=8443, path="/telegram",
+                secret_token=None, workers=4, max_connections=40):
+    """Serve Telegram's webhook over HTTP and fan updates out to worker processes.
+
+    Every worker runs its own Application built by ``build_application``.
+    Updates are sharded by user id, so a user's updates reach one worker in
+    the order they were received.
+    """
+    workers = max(1, workers)
+    queues = [multiprocessing.Queue() for _ in range(workers)]
+    processes = [
+        multiprocessing.Process(target=_worker_main, args=(i, workers, build_application, queues[i]), name=f"webhook-worker-{i}")
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    server = ThreadingHTTPServer((listen, port), _make_handler(path, secret_token, queues))
+    asyncio.run(_set_webhook(token, url, secret_token, max_connections))
+    logger.info("Webhook listening on %s:%s%s with %s workers.", listen, port, path, workers)
+
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join()